@@ -129,6 +129,157 @@ if __name__ == '__main__':
             print(line, end='')
             print('-'*20)
 
+# Searching for many patterns at once with an Aho-Corasick automaton.
+
+"""search() tests one substring per line, so looking for hundreds of
+terms means hundreds of passes over the file. An Aho-Corasick automaton
+finds every term in a single pass. The file is mmap'd and scanned as
+bytes; lines are tracked as (start, end) offsets and only the matching
+line and its context are ever sliced out."""
+
+import mmap
+import os
+from collections import namedtuple
+
+class AhoCorasick:
+    def __init__(self, patterns):
+        self.patterns = [p.encode('utf-8') if isinstance(p, str) else p
+                         for p in patterns]
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for pid, pat in enumerate(self.patterns):
+            state = 0
+            for c in pat:
+                nxt = self._goto[state].get(c)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][c] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = nxt
+            self._out[state] += (pid,)
+
+        # Breadth-first pass to fill in the failure links.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(c, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def iter_matches(self, data):
+        'Generate (end_offset, pattern_id) for every match in data'
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for i, c in enumerate(data):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for pid in out[state]:
+                yield i + 1, pid
+
+LineMatch = namedtuple('LineMatch', ['lineno', 'line', 'ids', 'before', 'after'])
+
+def search_many(filename, patterns, before=5, after=0, blocksize=1 << 20):
+    '''
+    Scan a file once for any of patterns, yielding a LineMatch for every
+    line that contains at least one of them.  ids is the sorted tuple of
+    pattern indexes found on the line; before/after are lists of the
+    neighbouring lines as bytes.
+    '''
+    ac = patterns if isinstance(patterns, AhoCorasick) else AhoCorasick(patterns)
+    goto, fail, out = ac._goto, ac._fail, ac._out
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            previous = deque(maxlen=before)
+            lineno = 1
+            line_start = 0
+            state = 0
+            found = set()
+            for block_start in range(0, size, blocksize):
+                block = data[block_start:block_start + blocksize]
+                for i, c in enumerate(block, block_start):
+                    if c == 10:
+                        if found:
+                            yield _line_match(data, lineno, line_start, i + 1,
+                                              found, previous, after, size)
+                            found = set()
+                        previous.append((line_start, i + 1))
+                        line_start = i + 1
+                        lineno += 1
+                        state = 0
+                        continue
+                    while state and c not in goto[state]:
+                        state = fail[state]
+                    state = goto[state].get(c, 0)
+                    if out[state]:
+                        found.update(out[state])
+            if found:
+                yield _line_match(data, lineno, line_start, size,
+                                  found, previous, after, size)
+
+def _line_match(data, lineno, start, end, found, previous, after, size):
+    following = []
+    pos = end
+    while len(following) < after and pos < size:
+        nl = data.find(b'\n', pos)
+        nxt = size if nl < 0 else nl + 1
+        following.append(data[pos:nxt])
+        pos = nxt
+    return LineMatch(lineno, data[start:end], tuple(sorted(found)),
+                     [data[s:e] for s, e in previous], following)
+
+# Benchmark against running search() once per pattern.
+
+import random
+import tempfile
+import time
+
+def bench_search_many(nlines=(20000, 80000), npatterns=(1, 10, 100)):
+    words = ['python', 'error', 'timeout', 'spam', 'grok', 'request',
+             'socket', 'retry', 'cache', 'disk']
+    for n in nlines:
+        rng = random.Random(n)
+        with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False) as f:
+            for i in range(n):
+                f.write('{} {} {}\n'.format(i, rng.choice(words),
+                                            rng.randrange(10**6)))
+            filename = f.name
+        try:
+            for k in npatterns:
+                terms = ['{}{}'.format(rng.choice(words), j) for j in range(k)]
+                start = time.perf_counter()
+                for term in terms:
+                    with open(filename) as f:
+                        for _ in search(f, term, 5):
+                            pass
+                t_search = time.perf_counter() - start
+                start = time.perf_counter()
+                for _ in search_many(filename, terms, before=5):
+                    pass
+                t_many = time.perf_counter() - start
+                print('{:>7d} lines {:>4d} patterns: search() {:.3f}s  '
+                      'search_many() {:.3f}s'.format(n, k, t_search, t_many))
+        finally:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    with tempfile.NamedTemporaryFile('w', delete=False) as f:
+        f.write('spam\nham\npython is fun\neggs\ngrok python\nspam\n')
+    for m in search_many(f.name, ['python', 'grok'], before=1, after=1):
+        print(m)
+    os.remove(f.name)
+    bench_search_many()
+
 
 # 1.4 Finding the Largest or Smallest N Items
 
@@ -167,6 +318,135 @@ print(heap)
 heapq.heappop(heap) # Take off from front of heap.
 print(heap)
 
+# Keeping the top N items of a stream.
+
+"""nlargest() needs the whole list every time it is called. TopK keeps a
+heap of at most n entries whose root is the worst item kept, so each
+add() is O(log n) and usually just one comparison against the root.
+Partial results from worker processes can be combined with merge(); a
+TopK pickles as long as its key does (use a module-level function or
+itemgetter rather than a lambda)."""
+
+from operator import itemgetter
+
+class _Reversed:
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+    def __lt__(self, other):
+        return other.value < self.value
+    def __eq__(self, other):
+        return self.value == other.value
+    def __getstate__(self):
+        return (self.value,)
+    def __setstate__(self, state):
+        self.value, = state
+
+class TopK:
+    def __init__(self, n, key=None, largest=True):
+        self.n = n
+        self.key = key
+        self.largest = largest
+        self._heap = []
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _sortkey(self, item):
+        value = item if self.key is None else self.key(item)
+        return value if self.largest else _Reversed(value)
+
+    def add(self, item):
+        self._push(self._sortkey(item), item)
+
+    def _push(self, sortkey, item):
+        heap = self._heap
+        # Later items lose ties, as with nlargest()/nsmallest().
+        self._count += 1
+        if len(heap) < self.n:
+            heapq.heappush(heap, (sortkey, -self._count, item))
+        elif heap and heap[0][0] < sortkey:
+            heapq.heapreplace(heap, (sortkey, -self._count, item))
+
+    def add_many(self, items):
+        heap = self._heap
+        key = self.key
+        largest = self.largest
+        count = -self._count
+        for item in items:
+            value = item if key is None else key(item)
+            sortkey = value if largest else _Reversed(value)
+            count -= 1
+            if len(heap) < self.n:
+                heapq.heappush(heap, (sortkey, count, item))
+            elif heap and heap[0][0] < sortkey:
+                heapq.heapreplace(heap, (sortkey, count, item))
+        self._count = -count
+
+    def merge(self, other):
+        'Fold another TopK (e.g. a per-process partial) into this one'
+        for sortkey, _, item in sorted(other._heap, reverse=True):
+            self._push(sortkey, item)
+        return self
+
+    def items(self):
+        'Return the kept items, best first'
+        return [item for _, _, item in sorted(self._heap, reverse=True)]
+
+top = TopK(3, key=itemgetter('price'))
+top.add_many(portfolio[:3])
+top.add_many(portfolio[3:])
+print(top.items())
+
+cheapest = TopK(3, key=itemgetter('price'), largest=False)
+for s in portfolio:
+    cheapest.add(s)
+print(cheapest.items() == heapq.nsmallest(3, portfolio, key=itemgetter('price')))
+
+# Combining partial results from a multiprocessing map.
+
+import multiprocessing
+import random
+import time
+
+def _chunk_top(chunk):
+    top = TopK(5)
+    top.add_many(chunk)
+    return top
+
+def bench_topk(n=20000, k=10):
+    rng = random.Random(0)
+    data = [rng.random() for _ in range(n)]
+
+    # Query the top k after every small update.
+    start = time.perf_counter()
+    seen = []
+    for x in data[:2000]:
+        seen.append(x)
+        heapq.nlargest(k, seen)
+    t_nlargest = time.perf_counter() - start
+
+    start = time.perf_counter()
+    top = TopK(k)
+    for x in data[:2000]:
+        top.add(x)
+        top.items()
+    t_topk = time.perf_counter() - start
+    print('2000 updates: nlargest() {:.3f}s  TopK {:.3f}s'.format(
+          t_nlargest, t_topk))
+
+    chunks = [data[i:i + n // 4] for i in range(0, n, n // 4)]
+    with multiprocessing.Pool(4) as pool:
+        partials = pool.map(_chunk_top, chunks)
+    total = TopK(5)
+    for p in partials:
+        total.merge(p)
+    print(total.items() == heapq.nlargest(5, data))
+
+if __name__ == '__main__':
+    bench_topk()
+
 
 # 1.5 Implementing a Priority Queue
 
@@ -201,6 +481,287 @@ print("Should be spam:", q.pop())
 print("Should be foo:", q.pop())
 print("Should be grok:", q.pop())
 
+# An indexed priority queue that can change or remove queued items.
+
+"""Changing a priority in PriorityQueue means pushing a duplicate and
+leaving the stale entry in the heap. IndexedPriorityQueue keeps each
+entry's heap position up to date, so push() can hand back a handle that
+is later used to update_priority() or remove() in O(log n). Removed
+entries leave the heap immediately, so memory stays bounded no matter
+how much churn there is. Entries are [-priority, index, item, pos]
+lists; index is unique, so comparisons never reach the item."""
+
+class IndexedPriorityQueue:
+    def __init__(self):
+        self._queue = []
+        self._index = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _entry(self, item, priority):
+        entry = [-priority, self._index, item, len(self._queue)]
+        self._index += 1
+        self._queue.append(entry)
+        return entry
+
+    def push(self, item, priority):
+        entry = self._entry(item, priority)
+        self._siftdown(entry[3])
+        return entry
+
+    def push_many(self, pairs):
+        'Push (item, priority) pairs and re-heapify in O(n)'
+        handles = [self._entry(item, priority) for item, priority in pairs]
+        for pos in reversed(range(len(self._queue) // 2)):
+            self._siftup(pos)
+        return handles
+
+    def peek(self):
+        return self._queue[0][2]
+
+    def pop(self):
+        return self._remove_at(0)[2]
+
+    def remove(self, handle):
+        self._check(handle)
+        return self._remove_at(handle[3])[2]
+
+    def update_priority(self, handle, priority):
+        self._check(handle)
+        old = handle[0]
+        # Take a fresh index so an updated item queues after equal priorities.
+        handle[0] = -priority
+        handle[1] = self._index
+        self._index += 1
+        if handle[0] < old:
+            self._siftdown(handle[3])
+        else:
+            self._siftup(handle[3])
+
+    def _check(self, handle):
+        pos = handle[3]
+        if pos < 0 or pos >= len(self._queue) or self._queue[pos] is not handle:
+            raise KeyError('Handle is no longer in the queue')
+
+    def _remove_at(self, pos):
+        queue = self._queue
+        entry = queue[pos]
+        last = queue.pop()
+        if last is not entry:
+            queue[pos] = last
+            last[3] = pos
+            self._siftup(pos)
+            self._siftdown(last[3])
+        entry[3] = -1
+        return entry
+
+    def _siftdown(self, pos):
+        'Move the entry at pos towards the root'
+        queue = self._queue
+        entry = queue[pos]
+        while pos > 0:
+            parentpos = (pos - 1) >> 1
+            parent = queue[parentpos]
+            if entry < parent:
+                queue[pos] = parent
+                parent[3] = pos
+                pos = parentpos
+            else:
+                break
+        queue[pos] = entry
+        entry[3] = pos
+
+    def _siftup(self, pos):
+        'Move the entry at pos towards the leaves'
+        queue = self._queue
+        endpos = len(queue)
+        entry = queue[pos]
+        childpos = 2 * pos + 1
+        while childpos < endpos:
+            rightpos = childpos + 1
+            if rightpos < endpos and queue[rightpos] < queue[childpos]:
+                childpos = rightpos
+            child = queue[childpos]
+            if child < entry:
+                queue[pos] = child
+                child[3] = pos
+                pos = childpos
+                childpos = 2 * pos + 1
+            else:
+                break
+        queue[pos] = entry
+        entry[3] = pos
+
+q = IndexedPriorityQueue()
+foo = q.push(Item('foo'), 1)
+bar = q.push(Item('bar'), 5)
+spam = q.push(Item('spam'), 4)
+q.push_many([(Item('grok'), 1), (Item('eggs'), 3)])
+
+q.update_priority(foo, 10)
+q.remove(spam)
+
+print("Should be foo:", q.pop())
+print("Should be bar:", q.peek(), q.pop())
+print("Should be eggs:", q.pop())
+print("Should be grok:", q.pop())
+
+# Sharing a priority queue between threads or asyncio tasks.
+
+"""BlockingPriorityQueue guards the heap with a Condition so consumers
+can wait for items, with an optional timeout. pop_many() drains up to n
+items under a single lock acquisition, which cuts contention when many
+consumers are busy. AsyncPriorityQueue is the same idea for coroutines.
+Both keep the (-priority, index, item) ordering of PriorityQueue."""
+
+import asyncio
+import threading
+from queue import Empty
+
+class BlockingPriorityQueue:
+    def __init__(self):
+        self._queue = []
+        self._index = 0
+        self._cv = threading.Condition()
+
+    def __len__(self):
+        with self._cv:
+            return len(self._queue)
+
+    def push(self, item, priority):
+        with self._cv:
+            heapq.heappush(self._queue, (-priority, self._index, item))
+            self._index += 1
+            self._cv.notify()
+
+    def push_many(self, pairs):
+        with self._cv:
+            for item, priority in pairs:
+                self._queue.append((-priority, self._index, item))
+                self._index += 1
+            heapq.heapify(self._queue)
+            self._cv.notify_all()
+
+    def pop(self, timeout=None):
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._queue, timeout):
+                raise Empty
+            return heapq.heappop(self._queue)[-1]
+
+    def pop_many(self, n, timeout=None):
+        'Wait for at least one item, then pop up to n of them'
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._queue, timeout):
+                raise Empty
+            queue = self._queue
+            return [heapq.heappop(queue)[-1]
+                    for _ in range(min(n, len(queue)))]
+
+class AsyncPriorityQueue:
+    def __init__(self):
+        self._queue = []
+        self._index = 0
+        self._cv = asyncio.Condition()
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def put(self, item, priority):
+        async with self._cv:
+            heapq.heappush(self._queue, (-priority, self._index, item))
+            self._index += 1
+            self._cv.notify()
+
+    async def get(self):
+        async with self._cv:
+            await self._cv.wait_for(lambda: self._queue)
+            return heapq.heappop(self._queue)[-1]
+
+    async def get_many(self, n):
+        async with self._cv:
+            await self._cv.wait_for(lambda: self._queue)
+            queue = self._queue
+            return [heapq.heappop(queue)[-1]
+                    for _ in range(min(n, len(queue)))]
+
+q = BlockingPriorityQueue()
+q.push_many([(Item('foo'), 1), (Item('bar'), 5), (Item('spam'), 4)])
+print("Should be bar, spam:", q.pop_many(2))
+print("Should be foo:", q.pop(timeout=1))
+
+async def async_example():
+    q = AsyncPriorityQueue()
+    await q.put(Item('foo'), 1)
+    await q.put(Item('bar'), 5)
+    print("Should be bar:", await q.get())
+    print("Should be foo:", await q.get())
+
+asyncio.run(async_example())
+
+# Contention benchmark: a global lock around PriorityQueue versus
+# BlockingPriorityQueue.pop_many().
+
+import time
+
+class _LockedPriorityQueue:
+    def __init__(self):
+        self._q = PriorityQueue()
+        self._lock = threading.Lock()
+        self._len = 0
+
+    def push(self, item, priority):
+        with self._lock:
+            self._q.push(item, priority)
+            self._len += 1
+
+    def pop(self):
+        # Busy-polls the way a lock-wrapped queue without a Condition must.
+        while True:
+            with self._lock:
+                if self._len:
+                    self._len -= 1
+                    return self._q.pop()
+            time.sleep(0)
+
+def _run_contention(nthreads, nitems, make_queue, consume):
+    q = make_queue()
+    per_thread = nitems // nthreads
+    def producer():
+        for i in range(per_thread):
+            q.push(i, i % 100)
+    def consumer():
+        remaining = per_thread
+        while remaining:
+            remaining -= consume(q, remaining)
+    threads = ([threading.Thread(target=producer) for _ in range(nthreads)] +
+               [threading.Thread(target=consumer) for _ in range(nthreads)])
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def _consume_one(q, remaining):
+    q.pop()
+    return 1
+
+def _consume_many(q, remaining):
+    return len(q.pop_many(min(64, remaining)))
+
+def bench_contention(nitems=64000, threads=(1, 2, 4, 8, 16, 32)):
+    for n in threads:
+        t_locked = _run_contention(n, nitems, _LockedPriorityQueue, _consume_one)
+        t_one = _run_contention(n, nitems, BlockingPriorityQueue, _consume_one)
+        t_many = _run_contention(n, nitems, BlockingPriorityQueue, _consume_many)
+        print('{:>2d} producers/consumers: global lock {:.3f}s  '
+              'pop() {:.3f}s  pop_many(64) {:.3f}s'.format(
+              n, t_locked, t_one, t_many))
+
+if __name__ == '__main__':
+    bench_contention()
+
 
 # 1.6 Mapping Keys to Multiple Values in a Dictionary
 
@@ -264,6 +825,173 @@ def defaultdict_show():
     
 defaultdict_show()
 
+# A compact multidict for large numeric data.
+
+"""defaultdict(list) pays for a list object per key plus an object per
+value. MultiDict keeps every value in one typed array. Each key maps to
+a slot number, and an offsets array gives the slot's range of values,
+like the row pointers of a CSR sparse matrix. Build it in bulk with
+from_pairs(). add() puts new values in a small per-key pending list.
+The pending values are merged into a fresh array slot by slot once
+there are at least compact_every of them and they make up an eighth of
+the array, so the total cost of compacting grows in proportion to the
+additions. d[key] always returns a memoryview; it is a view of the
+array, with no copy, when the key has no pending values."""
+
+import sys
+from array import array
+from collections.abc import Mapping
+
+class MultiDict(Mapping):
+    def __init__(self, typecode='q', compact_every=100000):
+        self.typecode = typecode
+        self.compact_every = compact_every
+        self._slots = {}
+        self._offsets = array('q', [0])
+        self._values = array(typecode)
+        self._pending = defaultdict(list)
+        self._npending = 0
+        self._nkeys = 0
+
+    @classmethod
+    def from_pairs(cls, pairs, typecode='q', compact_every=100000):
+        'Build from an iterable of (key, value) pairs'
+        self = cls(typecode, compact_every)
+        keys = []
+        values = array(typecode)
+        for key, value in pairs:
+            keys.append(key)
+            values.append(value)
+        self._build(keys, values)
+        return self
+
+    def _build(self, keys, values):
+        # keys and values are sequences; both are read twice.
+        slots = {}
+        counts = array('q')
+        for key in keys:
+            slot = slots.get(key)
+            if slot is None:
+                slot = slots[key] = len(counts)
+                counts.append(0)
+            counts[slot] += 1
+        offsets = array('q', [0])
+        for n in counts:
+            offsets.append(offsets[-1] + n)
+        fill = offsets[:-1]
+        out = array(self.typecode, bytes(offsets[-1] * array(self.typecode).itemsize))
+        for key, value in zip(keys, values):
+            slot = slots[key]
+            out[fill[slot]] = value
+            fill[slot] += 1
+        self._slots = slots
+        self._offsets = offsets
+        self._values = out
+        self._nkeys = len(slots)
+
+    def add(self, key, value):
+        if key not in self._pending and key not in self._slots:
+            self._nkeys += 1
+        self._pending[key].append(value)
+        self._npending += 1
+        # Compact once pending values are also an eighth of the store,
+        # so the cost of copying the store is spread over enough adds.
+        if (self._npending >= self.compact_every and
+                self._npending >= len(self._values) >> 3):
+            self.compact()
+
+    def compact(self):
+        'Fold the pending values into the value array, slot by slot'
+        if not self._npending:
+            return
+        old, offsets, slots = self._values, self._offsets, self._slots
+        pending = self._pending
+        values = array(self.typecode)
+        new_offsets = array('q', [0])
+        # Slots were numbered in insertion order, so this keeps them.
+        for key, slot in slots.items():
+            values += old[offsets[slot]:offsets[slot + 1]]
+            extra = pending.pop(key, None)
+            if extra:
+                values.extend(extra)
+            new_offsets.append(len(values))
+        for key, extra in pending.items():
+            slots[key] = len(new_offsets) - 1
+            values.extend(extra)
+            new_offsets.append(len(values))
+        pending.clear()
+        self._npending = 0
+        self._offsets = new_offsets
+        self._values = values
+
+    def __getitem__(self, key):
+        slot = self._slots.get(key)
+        if key in self._pending:
+            values = array(self.typecode)
+            if slot is not None:
+                values = self._values[self._offsets[slot]:self._offsets[slot + 1]]
+            values += array(self.typecode, self._pending[key])
+            return memoryview(values)
+        if slot is None:
+            raise KeyError(key)
+        return memoryview(self._values)[self._offsets[slot]:self._offsets[slot + 1]]
+
+    def __iter__(self):
+        yield from self._slots
+        for key in self._pending:
+            if key not in self._slots:
+                yield key
+
+    def __len__(self):
+        return self._nkeys
+
+    @property
+    def nbytes(self):
+        'Approximate bytes used by the value array and key index'
+        return (sys.getsizeof(self._values) + sys.getsizeof(self._offsets) +
+                sys.getsizeof(self._slots))
+
+pairs = [('a', 1), ('a', 2), ('b', 4), ('a', 3), ('b', 5)]
+edges = MultiDict.from_pairs(pairs)
+print(list(edges['a']), list(edges['b']))
+edges.add('c', 6)
+edges.add('a', 7)
+print(list(edges['a']), list(edges['c']))
+edges.compact()
+print(dict((key, list(values)) for key, values in edges.items()))
+
+if __name__ == '__main__':
+    import random
+    import time
+    import tracemalloc
+
+    rng = random.Random(0)
+    n = 2000000
+    src = array('q', (rng.randrange(100000) for _ in range(n)))
+    dst = array('q', (rng.randrange(100000) for _ in range(n)))
+
+    tracemalloc.start()
+    adj = defaultdict(list)
+    for s, d in zip(src, dst):
+        adj[s].append(d)
+    dd_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    compact = MultiDict.from_pairs(zip(src, dst))
+    md_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('defaultdict(list) {:,} bytes  MultiDict {:,} bytes'.format(
+          dd_bytes, md_bytes))
+
+    probes = [rng.randrange(100000) for _ in range(200000)]
+    for label, m in [('defaultdict(list)', adj), ('MultiDict', compact)]:
+        start = time.perf_counter()
+        for key in probes:
+            len(m[key])
+        print('{:>17s}: 200,000 lookups {:.3f}s'.format(
+              label, time.perf_counter() - start))
+
 
 # 1.7 Keeping Dictionaries in Order
 
@@ -319,6 +1047,195 @@ prices = { 'AAA' : 45.23, 'ZZZ': 45.23 }
 print(min(zip(prices.values(), prices.keys()))) 
 print(max(zip(prices.values(), prices.keys())))
 
+# Keeping a dictionary ordered by value as it changes.
+
+"""Recomputing min(zip(prices.values(), prices.keys())) costs O(n) on
+every query. ValueOrderedDict keeps the same (value, key) pairs in a
+sorted index while entries are set and deleted. The index is a list of
+sorted chunks of at most 2 * load pairs, with a Fenwick tree over the
+chunk lengths, so min_item(), max_item(), rank(), nth() and the start
+of range() are O(log n). Keys must be orderable to break value ties,
+exactly as with the zip() version."""
+
+from bisect import bisect_left, insort
+from collections.abc import MutableMapping
+
+class ValueOrderedDict(MutableMapping):
+    def __init__(self, *args, load=500, **kwargs):
+        self._data = {}
+        self._load = load
+        self._chunks = []
+        self._maxes = []
+        self._tree = []
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._remove((self._data[key], key))
+        self._data[key] = value
+        self._insert((value, key))
+
+    def __delitem__(self, key):
+        value = self._data.pop(key)
+        self._remove((value, key))
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'ValueOrderedDict({!r})'.format(self._data)
+
+    # Order statistics, all returned as (value, key) like the zip() idiom.
+
+    def min_item(self):
+        return self._chunks[0][0]
+
+    def max_item(self):
+        return self._chunks[-1][-1]
+
+    def rank(self, key):
+        'Position of key in value order'
+        pair = (self._data[key], key)
+        i = bisect_left(self._maxes, pair)
+        return self._prefix(i) + bisect_left(self._chunks[i], pair)
+
+    def nth(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError('index out of range')
+        i, offset = self._find(n)
+        return self._chunks[i][offset]
+
+    def range(self, lo=None, hi=None):
+        'Generate (value, key) pairs with lo <= value < hi in order'
+        if lo is None:
+            i = j = 0
+        else:
+            i = bisect_left(self._maxes, (lo,))
+            j = bisect_left(self._chunks[i], (lo,)) if i < len(self._chunks) else 0
+        for chunk in self._chunks[i:]:
+            for pair in chunk[j:]:
+                if hi is not None and not pair[0] < hi:
+                    return
+                yield pair
+            j = 0
+
+    # The chunked index.
+
+    def _insert(self, pair):
+        chunks, maxes = self._chunks, self._maxes
+        if not chunks:
+            chunks.append([pair])
+            maxes.append(pair)
+            self._rebuild_tree()
+            return
+        i = bisect_left(maxes, pair)
+        if i == len(maxes):
+            i -= 1
+        chunk = chunks[i]
+        insort(chunk, pair)
+        maxes[i] = chunk[-1]
+        if len(chunk) > 2 * self._load:
+            chunks[i:i + 1] = [chunk[:self._load], chunk[self._load:]]
+            maxes[i:i + 1] = [chunk[self._load - 1], chunk[-1]]
+            self._rebuild_tree()
+        else:
+            self._update(i, 1)
+
+    def _remove(self, pair):
+        chunks, maxes = self._chunks, self._maxes
+        i = bisect_left(maxes, pair)
+        chunk = chunks[i]
+        del chunk[bisect_left(chunk, pair)]
+        if chunk:
+            maxes[i] = chunk[-1]
+            self._update(i, -1)
+        else:
+            del chunks[i]
+            del maxes[i]
+            self._rebuild_tree()
+
+    def _rebuild_tree(self):
+        tree = [len(chunk) for chunk in self._chunks]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _update(self, i, delta):
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i |= i + 1
+
+    def _prefix(self, i):
+        'Number of pairs in the first i chunks'
+        tree = self._tree
+        total = 0
+        while i > 0:
+            total += tree[i - 1]
+            i &= i - 1
+        return total
+
+    def _find(self, n):
+        'Return (chunk, offset) of the n-th pair'
+        tree = self._tree
+        pos = 0
+        step = 1 << (len(tree).bit_length())
+        while step:
+            nxt = pos + step
+            if nxt <= len(tree) and tree[nxt - 1] <= n:
+                pos = nxt
+                n -= tree[nxt - 1]
+            step >>= 1
+        return pos, n
+
+prices = ValueOrderedDict({
+    'ACME': 45.23,
+    'AAPL': 612.78,
+    'IBM': 205.55,
+    'HPQ': 37.20,
+    'FB': 10.75
+})
+
+print(prices.min_item(), prices.max_item())
+prices['FB'] = 700.0
+print(prices.min_item(), prices.max_item())
+print(prices.rank('IBM'), prices.nth(1), list(prices.range(40, 300)))
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    rng = random.Random(0)
+    names = ['S{}'.format(i) for i in range(100000)]
+    plain = {name: rng.random() for name in names}
+    ordered = ValueOrderedDict(plain)
+
+    start = time.perf_counter()
+    for _ in range(200):
+        plain[rng.choice(names)] = rng.random()
+        min(zip(plain.values(), plain.keys()))
+        max(zip(plain.values(), plain.keys()))
+    t_plain = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(200):
+        ordered[rng.choice(names)] = rng.random()
+        ordered.min_item()
+        ordered.max_item()
+    t_ordered = time.perf_counter() - start
+    print('200 updates + min/max on 100,000 prices: recompute {:.3f}s  '
+          'ValueOrderedDict {:.4f}s'.format(t_plain, t_ordered))
+
 
 # 1.9 Finding Commonalities in Two Dictionaries
 
@@ -347,6 +1264,131 @@ print(a.items() & b.items())
 c = {key:a[key] for key in a.keys() - {'z', 'w'}}
 print(c)
 
+# Diffing large dictionaries.
+
+"""a.items() - b.items() builds a full set of item tuples. dict_diff()
+walks b once, looking each key up in a, and a once for the removed
+keys; nothing but the result lists is built."""
+
+def dict_diff(a, b):
+    'Return (added, removed, changed) keys going from a to b'
+    added = []
+    changed = []
+    for key, value in b.items():
+        if key not in a:
+            added.append(key)
+        elif a[key] != value:
+            changed.append(key)
+    removed = [key for key in a if key not in b]
+    return added, removed, changed
+
+print(dict_diff(a, b))
+
+# Diffing dictionaries held by different processes.
+
+"""Each side hashes its items into nbuckets buckets and builds a Merkle
+tree over the bucket digests. The client walks the tree level by level,
+asking the server only for the children of nodes whose digests differ,
+and finally fetches just the differing buckets. Buckets are chosen from
+a blake2b hash of the pickled key, since hash() of a str changes from
+process to process. The messages go over multiprocessing.connection,
+as in recipe 11.7."""
+
+import hashlib
+import pickle
+from multiprocessing.connection import Client, Listener
+
+def _digest(obj):
+    return hashlib.blake2b(pickle.dumps(obj, protocol=4), digest_size=16).digest()
+
+class MerkleDict:
+    def __init__(self, d, nbuckets=1024):
+        if nbuckets & (nbuckets - 1):
+            raise ValueError('nbuckets must be a power of two')
+        self.d = d
+        self.nbuckets = nbuckets
+        self.buckets = [[] for _ in range(nbuckets)]
+        leaves = [0] * nbuckets
+        for key, value in d.items():
+            kd = _digest(key)
+            i = int.from_bytes(kd[:8], 'little') & (nbuckets - 1)
+            self.buckets[i].append(key)
+            # XOR makes a bucket digest independent of insertion order.
+            leaves[i] ^= int.from_bytes(_digest((kd, value)), 'little')
+        level = [leaf.to_bytes(16, 'little') for leaf in leaves]
+        self.levels = [level]
+        while len(level) > 1:
+            level = [hashlib.blake2b(level[i] + level[i + 1],
+                                     digest_size=16).digest()
+                     for i in range(0, len(level), 2)]
+            self.levels.insert(0, level)
+
+    def bucket_items(self, i):
+        return {key: self.d[key] for key in self.buckets[i]}
+
+def serve_merkle(d, address, authkey, nbuckets=1024):
+    'Serve one diff session for d, then return'
+    tree = MerkleDict(d, nbuckets)
+    with Listener(address, authkey=authkey) as serv:
+        with serv.accept() as conn:
+            while True:
+                try:
+                    msg, level, indexes = conn.recv()
+                except EOFError:
+                    break
+                if msg == 'nodes':
+                    conn.send([tree.levels[level][i] for i in indexes])
+                elif msg == 'buckets':
+                    conn.send([tree.bucket_items(i) for i in indexes])
+
+def remote_dict_diff(a, address, authkey, nbuckets=1024):
+    'Like dict_diff(a, b) where b is served by serve_merkle()'
+    tree = MerkleDict(a, nbuckets)
+    with Client(address, authkey=authkey) as conn:
+        indexes = [0]
+        for level, digests in enumerate(tree.levels):
+            conn.send(('nodes', level, indexes))
+            remote = conn.recv()
+            differ = [i for i, digest in zip(indexes, remote)
+                      if digest != digests[i]]
+            if level + 1 < len(tree.levels):
+                indexes = [child for i in differ for child in (2 * i, 2 * i + 1)]
+            else:
+                indexes = differ
+            if not indexes:
+                return [], [], []
+        conn.send(('buckets', None, indexes))
+        remote_buckets = conn.recv()
+    added, removed, changed = [], [], []
+    for i, b in zip(indexes, remote_buckets):
+        diff = dict_diff(tree.bucket_items(i), b)
+        added += diff[0]
+        removed += diff[1]
+        changed += diff[2]
+    return added, removed, changed
+
+if __name__ == '__main__':
+    import multiprocessing
+    import time
+
+    local = {'k{}'.format(i): i for i in range(100000)}
+    remote = dict(local)
+    remote['k5'] = -5
+    del remote['k7']
+    remote['new'] = 1
+
+    address = ('localhost', 25001)
+    server = multiprocessing.Process(target=serve_merkle,
+                                     args=(remote, address, b'peekaboo'))
+    server.start()
+    for _ in range(50):
+        try:
+            print(remote_dict_diff(local, address, b'peekaboo'))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    server.join()
+
 
 # 1.10 Removing Duplicates from a Sequence while Maintaining Order
 
@@ -374,6 +1416,170 @@ a = [ {'x':1, 'y':2}, {'x':1, 'y':3}, {'x':1, 'y':2}, {'x':2, 'y':4}]
 print(list(dedupe(a, key=lambda d: (d['x'],d['y']))))
 print(list(dedupe(a, key=lambda d: d['x'])))
 
+# Removing duplicates from streams too big for a set.
+
+"""dedupe() keeps every key it has seen in a set. dedupe_approx() keeps
+a Bloom filter instead: memory is fixed up front from the expected
+number of keys and the false-positive rate (or capped with max_bytes),
+and the price is that a rare unique item is dropped as a duplicate.
+
+dedupe_spill() stays exact. Keys are reduced to 16-byte digests, and
+once max_keys of them are held in memory they are sorted and written to
+a run file that is searched with binary search through mmap. Once
+max_runs runs of a similar size build up they are merged into one, in
+tiers like a merge sort, so each digest is rewritten only a logarithmic
+number of times and few runs need searching. Both work from a
+blake2b digest of the pickled key rather than hash(), so keys need a
+stable pickle (strings, numbers, tuples of them). Both are generators
+that keep first-occurrence order."""
+
+import hashlib
+import math
+import mmap
+import pickle
+import tempfile
+
+_DIGEST_SIZE = 16
+
+def _key_digest(key):
+    return hashlib.blake2b(pickle.dumps(key, protocol=4),
+                           digest_size=_DIGEST_SIZE).digest()
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001, max_bytes=None):
+        nbits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if max_bytes is not None:
+            nbits = min(nbits, max_bytes * 8)
+        self.nbits = max(nbits, 8)
+        self.nhashes = max(1, round(self.nbits / max(capacity, 1) * math.log(2)))
+        self._bits = bytearray((self.nbits + 7) // 8)
+
+    @staticmethod
+    def _hashes(key):
+        # Two 64-bit halves of one digest; h2 is made odd so it is never 0.
+        digest = _key_digest(key)
+        return (int.from_bytes(digest[:8], 'little'),
+                int.from_bytes(digest[8:], 'little') | 1)
+
+    def add(self, key):
+        'Add key, returning True if it was (probably) already present'
+        h1, h2 = self._hashes(key)
+        bits, nbits = self._bits, self.nbits
+        present = True
+        for i in range(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & mask:
+                present = False
+                bits[byte] |= mask
+        return present
+
+    def __contains__(self, key):
+        h1, h2 = self._hashes(key)
+        bits, nbits = self._bits, self.nbits
+        for i in range(self.nhashes):
+            pos = (h1 + i * h2) % nbits
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+def dedupe_approx(items, key=None, capacity=10**6, error_rate=0.001,
+                  max_bytes=None):
+    seen = BloomFilter(capacity, error_rate, max_bytes)
+    for item in items:
+        val = item if key is None else key(item)
+        if not seen.add(val):
+            yield item
+
+class _DigestRuns:
+    'Sorted runs of fixed-size digests kept in temporary files'
+    def __init__(self, max_runs=8, dir=None):
+        if max_runs < 2:
+            raise ValueError('max_runs must be at least 2')
+        self.max_runs = max_runs
+        self.dir = dir
+        # _levels[i] holds runs made of about max_runs**i spills.
+        self._levels = []
+
+    def __contains__(self, digest):
+        for data, n in (run for level in self._levels for run in level):
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = mid * _DIGEST_SIZE
+                rec = data[start:start + _DIGEST_SIZE]
+                if rec < digest:
+                    lo = mid + 1
+                elif rec > digest:
+                    hi = mid
+                else:
+                    return True
+        return False
+
+    def add_run(self, digests):
+        run = self._write(sorted(digests))
+        level = 0
+        while run is not None:
+            if level == len(self._levels):
+                self._levels.append([])
+            runs = self._levels[level]
+            runs.append(run)
+            if len(runs) < self.max_runs:
+                break
+            # Merge only runs of a similar size, so each digest is
+            # rewritten about log(number of spills, max_runs) times.
+            run = self._write(heapq.merge(*(self._records(data, n)
+                                            for data, n in runs)))
+            for data, _ in runs:
+                data.close()
+            self._levels[level] = []
+            level += 1
+
+    def _records(self, data, n):
+        for i in range(0, n * _DIGEST_SIZE, _DIGEST_SIZE):
+            yield data[i:i + _DIGEST_SIZE]
+
+    def _write(self, digests):
+        n = 0
+        with tempfile.TemporaryFile(dir=self.dir) as f:
+            for d in digests:
+                f.write(d)
+                n += 1
+            f.flush()
+            if n:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), n
+        return None
+
+    def close(self):
+        for level in self._levels:
+            for data, _ in level:
+                data.close()
+        self._levels = []
+
+def dedupe_spill(items, key=None, max_keys=10**6, max_runs=8, dir=None):
+    seen = set()
+    runs = _DigestRuns(max_runs, dir)
+    try:
+        for item in items:
+            val = item if key is None else key(item)
+            digest = _key_digest(val)
+            if digest in seen or digest in runs:
+                continue
+            yield item
+            seen.add(digest)
+            if len(seen) >= max_keys:
+                runs.add_run(seen)
+                seen = set()
+    finally:
+        runs.close()
+
+a = [1, 5, 2, 1, 9, 1, 5, 10]
+print(list(dedupe_approx(a, capacity=100)))
+print(list(dedupe_spill(a, max_keys=2, max_runs=2)))
+
+a = [ {'x':1, 'y':2}, {'x':1, 'y':3}, {'x':1, 'y':2}, {'x':2, 'y':4}]
+print(list(dedupe_spill(a, key=lambda d: (d['x'],d['y']), max_keys=1)))
+
 
 # 1.11 Naming a Slice
 
@@ -397,6 +1603,120 @@ print(a.start)
 print(a.stop)
 print(a.step)
 
+# Reading whole columns of a fixed-width file with named slices.
+
+"""Applying SHARES = slice(20, 23) to one record string at a time is
+slow for big extracts. FixedWidthReader mmaps the file and views a
+chunk of it as a 2-D (records x record length) array of bytes. Each
+named slice is then a strided view of that array, and a column is
+decoded in one astype() call. Only chunk_records records are decoded
+at a time, so files larger than memory are read in pieces. Every
+record must be the same length, including its newline."""
+
+import mmap
+import numpy as np
+
+class FixedWidthReader:
+    def __init__(self, filename, fields, reclen=None, chunk_records=1 << 20):
+        '''
+        fields maps a column name to (slice, type), where type is int,
+        float, str, bytes or a NumPy dtype.
+        '''
+        self.filename = filename
+        self.fields = fields
+        self.chunk_records = chunk_records
+        self._file = open(filename, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._mm = (mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                    if self._size else b'')
+        if reclen is None:
+            nl = self._mm.find(b'\n')
+            reclen = nl + 1 if nl >= 0 else self._size
+        self.reclen = reclen
+
+    def __len__(self):
+        return -(-self._size // self.reclen) if self.reclen else 0
+
+    def close(self):
+        if self._size:
+            self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _decode(self, records):
+        columns = {}
+        for name, (field, kind) in self.fields.items():
+            start, stop, _ = field.indices(self.reclen)
+            col = np.ascontiguousarray(records[:, start:stop]).view(
+                  'S{}'.format(stop - start)).ravel()
+            if kind is bytes:
+                # Copy, so no view of the mmap outlives the reader.
+                columns[name] = col.copy()
+            elif kind is str:
+                columns[name] = np.char.strip(col.astype('U'))
+            else:
+                columns[name] = col.astype(kind)
+        return columns
+
+    def chunks(self):
+        'Generate a dict of column arrays for each chunk of records'
+        if not self._size:
+            return
+        reclen = self.reclen
+        full = self._size // reclen
+        for first in range(0, full, self.chunk_records):
+            count = min(self.chunk_records, full - first)
+            records = np.frombuffer(self._mm, dtype=np.uint8,
+                                    count=count * reclen,
+                                    offset=first * reclen).reshape(count, reclen)
+            yield self._decode(records)
+        tail = self._mm[full * reclen:]
+        if tail:
+            # Last record without its newline.
+            padded = tail.ljust(reclen, b'\n')
+            yield self._decode(np.frombuffer(padded, dtype=np.uint8).reshape(1, reclen))
+
+    def read(self):
+        parts = list(self.chunks())
+        if not parts:
+            return {name: np.array([], dtype=kind)
+                    for name, (_, kind) in self.fields.items()}
+        return {name: np.concatenate([p[name] for p in parts])
+                for name in self.fields}
+
+import tempfile
+
+record = '....................100 .......513.25 ..........\n'
+with tempfile.NamedTemporaryFile('w', delete=False) as f:
+    f.write(record)
+    f.write(record.replace('100', '250').replace('513.25', '101.50'))
+    f.write(record.replace('100', ' 75').replace('513.25', ' 12.00').rstrip('\n'))
+
+SHARES = slice(20, 23)
+PRICE = slice(31, 37)
+
+with FixedWidthReader(f.name, {'shares': (SHARES, int),
+                               'price': (PRICE, float)},
+                      chunk_records=2) as reader:
+    columns = reader.read()
+    print(columns['shares'], columns['price'])
+    print(np.dot(columns['shares'], columns['price']))
+os.remove(f.name)
+
+# An empty file gives empty columns.
+
+with tempfile.NamedTemporaryFile('w', delete=False) as f:
+    pass
+
+with FixedWidthReader(f.name, {'shares': (SHARES, int)}) as reader:
+    print(len(reader), reader.read())
+os.remove(f.name)
+
 
 # 1.12 Determining the Most Frequently Occurring Items in a Sequence
 # The collections.Counter class is designed for this problem.
@@ -445,6 +1765,173 @@ print(c)
 d = a - b
 print(d)
 
+# Counting the words of a large file in parallel.
+
+"""The file is cut into byte ranges that end on line boundaries, each
+range is counted in a worker process and the partial Counters are
+added together. Each worker opens the file itself, so only the
+(filename, start, end) triple is sent to it."""
+
+import multiprocessing
+import os
+
+def _line_chunks(filename, nchunks):
+    size = os.path.getsize(filename)
+    step = max(1, size // nchunks)
+    chunks = []
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + step, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((filename, start, end))
+            start = end
+    return chunks
+
+def _count_chunk(chunk):
+    filename, start, end = chunk
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return Counter(data.decode('utf-8', errors='replace').split())
+
+def parallel_word_count(filename, processes=None, nchunks=None):
+    processes = processes or os.cpu_count()
+    chunks = _line_chunks(filename, nchunks or processes * 4)
+    total = Counter()
+    with multiprocessing.Pool(processes) as pool:
+        for partial in pool.imap_unordered(_count_chunk, chunks):
+            total.update(partial)
+    return total
+
+# Approximate counting in fixed memory.
+
+"""When there are too many distinct words to keep a Counter, a Count-Min
+sketch gives an estimate (never an undercount) for any word in
+width * depth counters, and Space-Saving keeps the k words most likely
+to be the heaviest. Together they answer most_common() like a Counter."""
+
+from array import array
+
+class CountMinSketch:
+    def __init__(self, width=1 << 16, depth=4):
+        self.width = width
+        self.depth = depth
+        self._rows = [array('Q', bytes(8 * width)) for _ in range(depth)]
+
+    def add(self, item, count=1):
+        width = self.width
+        estimate = None
+        for seed, row in enumerate(self._rows):
+            i = hash((seed, item)) % width
+            row[i] += count
+            if estimate is None or row[i] < estimate:
+                estimate = row[i]
+        return estimate
+
+    def __getitem__(self, item):
+        width = self.width
+        return min(row[hash((seed, item)) % width]
+                   for seed, row in enumerate(self._rows))
+
+class SpaceSaving:
+    def __init__(self, k=100):
+        self.k = k
+        self._counts = {}
+        self._heap = []
+
+    def add(self, item, count=1):
+        counts = self._counts
+        if item in counts:
+            counts[item] += count
+        elif len(counts) < self.k:
+            counts[item] = count
+        else:
+            # Evict the smallest counter; heap entries may be stale.
+            heap = self._heap
+            while True:
+                c, victim = heapq.heappop(heap)
+                if counts.get(victim) == c:
+                    break
+            del counts[victim]
+            counts[item] = c + count
+        heapq.heappush(self._heap, (counts[item], item))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(c, w) for w, c in counts.items()]
+            heapq.heapify(self._heap)
+
+    def most_common(self, n=None):
+        return heapq.nlargest(n or self.k, self._counts.items(),
+                              key=itemgetter(1))
+
+class ApproxCounter:
+    def __init__(self, k=100, width=1 << 16, depth=4):
+        self.sketch = CountMinSketch(width, depth)
+        self.top = SpaceSaving(k)
+
+    def update(self, items):
+        sketch_add = self.sketch.add
+        top_add = self.top.add
+        for item in items:
+            sketch_add(item)
+            top_add(item)
+
+    def __getitem__(self, item):
+        return self.sketch[item]
+
+    def most_common(self, n=None):
+        'Heavy hitters with their Count-Min estimates'
+        return sorted(((w, self.sketch[w]) for w, _ in self.top.most_common()),
+                      key=itemgetter(1), reverse=True)[:n or self.top.k]
+
+approx = ApproxCounter(k=10, width=256)
+approx.update(words)
+print(approx.most_common(5))
+
+import random
+import tempfile
+import time
+
+def bench_word_count(nwords=2000000):
+    rng = random.Random(0)
+    vocab = ['w{}'.format(int(rng.paretovariate(1.2))) for _ in range(5000)]
+    with tempfile.NamedTemporaryFile('w', delete=False) as f:
+        for i in range(0, nwords, 10):
+            f.write(' '.join(rng.choices(vocab, k=10)) + '\n')
+        filename = f.name
+    try:
+        start = time.perf_counter()
+        counts = Counter()
+        with open(filename) as f:
+            for line in f:
+                counts.update(line.split())
+        t_single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pcounts = parallel_word_count(filename)
+        t_parallel = time.perf_counter() - start
+
+        start = time.perf_counter()
+        approx = ApproxCounter(k=20)
+        with open(filename) as f:
+            for line in f:
+                approx.update(line.split())
+        t_approx = time.perf_counter() - start
+
+        print(pcounts == counts)
+        print([w for w, _ in approx.most_common(5)],
+              [w for w, _ in counts.most_common(5)])
+        for label, t in [('Counter.update', t_single),
+                         ('parallel_word_count', t_parallel),
+                         ('ApproxCounter', t_approx)]:
+            print('{:>20s}: {:>12,.0f} words/sec'.format(label, nwords / t))
+    finally:
+        os.remove(filename)
+
+if __name__ == '__main__':
+    bench_word_count()
+
 
 # 1.13 Sorting a List of Dictionaries by a Common Key
 
@@ -475,6 +1962,118 @@ rows_by_lfname = sorted(rows, key=lambda r: (r['lname'],r['fname']))
 print(min(rows, key=itemgetter('uid')))
 print(max(rows, key=itemgetter('uid')))
 
+# Sorting the same rows over and over with a columnar table.
+
+"""sorted(rows, key=itemgetter(...)) extracts the key from every row on
+every query. RecordTable stores each field as a NumPy column, computes
+the argsort permutation for a set of keys once and caches it. After
+that a sorted query is just an index lookup and a range query is a
+binary search plus a slice. Rows come back as lightweight views that
+read from the columns on demand."""
+
+from collections.abc import Mapping, Sequence
+import numpy as np
+
+class RowView(Mapping):
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, name):
+        return self._table.columns[name].item(self._index)
+
+    def __iter__(self):
+        return iter(self._table.columns)
+
+    def __len__(self):
+        return len(self._table.columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class RowSequence(Sequence):
+    'Rows of a table in the order given by an array of row indexes'
+    def __init__(self, table, indexes):
+        self._table = table
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return RowSequence(self._table, self._indexes[i])
+        return RowView(self._table, int(self._indexes[i]))
+
+    def __repr__(self):
+        return repr(list(self))
+
+class RecordTable:
+    def __init__(self, columns):
+        self.columns = {name: np.asarray(values) for name, values in columns.items()}
+        lengths = {len(col) for col in self.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError('Columns must all have the same length')
+        self._len = lengths.pop() if lengths else 0
+        self._perms = {}
+        self._sorted_cols = {}
+
+    @classmethod
+    def from_dicts(cls, rows, names=None):
+        if names is None:
+            names = list(rows[0]) if rows else []
+        return cls({name: [row[name] for row in rows] for name in names})
+
+    @classmethod
+    def from_objects(cls, objs, names):
+        return cls({name: [getattr(obj, name) for obj in objs] for name in names})
+
+    def __len__(self):
+        return self._len
+
+    def argsort(self, *names, reverse=False):
+        'Return the cached (stable) permutation that sorts by names'
+        perm = self._perms.get((names, reverse))
+        if perm is None:
+            # lexsort() sorts by its last key first.
+            keys = [self.columns[name] for name in reversed(names)]
+            if reverse:
+                # Sort the rows back to front and flip the result, so
+                # ties keep their order as with sorted(reverse=True).
+                perm = np.lexsort([key[::-1] for key in keys])
+                perm = (self._len - 1 - perm)[::-1]
+            else:
+                perm = np.lexsort(keys)
+            self._perms[names, reverse] = perm
+        return perm
+
+    def sorted(self, *names, reverse=False):
+        return RowSequence(self, self.argsort(*names, reverse=reverse))
+
+    def min(self, name):
+        return self.sorted(name)[0]
+
+    def max(self, name):
+        return self.sorted(name, reverse=True)[0]
+
+    def range(self, name, lo=None, hi=None):
+        'Rows with lo <= row[name] < hi, in sorted order'
+        perm = self.argsort(name)
+        col = self._sorted_cols.get(name)
+        if col is None:
+            col = self._sorted_cols[name] = self.columns[name][perm]
+        start = 0 if lo is None else np.searchsorted(col, lo, 'left')
+        stop = len(col) if hi is None else np.searchsorted(col, hi, 'left')
+        return RowSequence(self, perm[start:stop])
+
+table = RecordTable.from_dicts(rows)
+print(table.sorted('fname'))
+print(table.sorted('lname', 'fname'))
+print(table.range('uid', 1003, 1005))
+print(table.min('uid'), table.max('uid'))
+
 
 # 1.14 Sorting Objects Without Native Comparison Support
 
@@ -505,6 +2104,11 @@ by_name = sorted(users, key=attrgetter('last_name', 'first_name'))
 print(min(users, key=attrgetter('user_id')))
 print(max(users, key=attrgetter('user_id')))
 
+# The same with a RecordTable built from the objects.
+
+user_table = RecordTable.from_objects(users, ['user_id'])
+print([users[i] for i in user_table.argsort('user_id')])
+
 
 # 1.15 Grouping Records Together Based on a Field
 # Using itertools.groupby()
@@ -542,6 +2146,102 @@ for row in rows:
         for r in rows_by_date['07/01/2012']:
                 print(r)
 
+# Grouping records that don't fit in memory.
+
+"""external_groupby() sorts at most max_rows records at a time, writes
+each sorted run to a temporary file as a stream of pickles and then
+merges the runs with heapq.merge(), so groups come out one at a time
+just like groupby(). Records are stored as (key, seq, record); seq keeps
+the original order within a group and means records themselves are
+never compared. Runs waiting to be merged are kept as closed files and
+only opened to be read. They are merged level by level like a merge
+sort, max_files - 1 at a time into one new file, so no more than
+max_files files are ever open at once."""
+
+import os
+import pickle
+import tempfile
+from heapq import merge
+
+def _remove_run(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _write_run(records, dir):
+    fd, path = tempfile.mkstemp(dir=dir)
+    with os.fdopen(fd, 'wb') as f:
+        dump = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL).dump
+        for rec in records:
+            dump(rec)
+    return path
+
+def _read_run(path):
+    try:
+        with open(path, 'rb') as f:
+            load = pickle.Unpickler(f).load
+            while True:
+                try:
+                    yield load()
+                except EOFError:
+                    break
+    finally:
+        _remove_run(path)
+
+def _add_run(levels, run, fan_in, dir):
+    # levels[i] holds runs made of fan_in**i spills. A full level is
+    # merged into one run on the next, so each record is rewritten
+    # about log(number of spills, fan_in) times in all.
+    level = 0
+    while True:
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(run)
+        if len(levels[level]) < fan_in:
+            return
+        run = _write_run(merge(*map(_read_run, levels[level])), dir)
+        levels[level] = []
+        level += 1
+
+def external_groupby(records, key, max_rows=100000, max_files=64, dir=None):
+    if max_files < 3:
+        raise ValueError('max_files must be at least 3')
+    # Leave one file free for the output of each merge.
+    fan_in = max_files - 1
+    levels = []
+    runs = []
+    try:
+        batch = []
+        for seq, rec in enumerate(records):
+            batch.append((key(rec), seq, rec))
+            if len(batch) >= max_rows:
+                batch.sort()
+                _add_run(levels, _write_run(batch, dir), fan_in, dir)
+                batch = []
+        # Smallest runs first, so the final clean-up merges rewrite little.
+        runs = [run for level in levels for run in level]
+        levels = []
+        while len(runs) > max_files:
+            runs.append(_write_run(merge(*map(_read_run, runs[:fan_in])), dir))
+            del runs[:fan_in]
+        batch.sort()
+        if runs:
+            merged = merge(batch, *map(_read_run, runs))
+        else:
+            merged = batch
+        for k, group in groupby(merged, key=itemgetter(0)):
+            yield k, (rec for _, _, rec in group)
+    finally:
+        # Runs not yet read when the caller stops early.
+        for path in runs + [run for level in levels for run in level]:
+            _remove_run(path)
+
+for date, items in external_groupby(rows, key=itemgetter('date'), max_rows=3):
+    print(date)
+    for i in items:
+        print('     ', i)
+
 
 # 1.16 Filtering Sequence Elements
 
@@ -611,6 +2311,228 @@ print(more5)
 
 print(list(compress(addresses, more5)))
 
+# Compiling filter expressions.
+
+"""compile_filter() turns a small expression such as
+'x > 0 and x not in (3, 10)' into a FilterExpr. filter() runs it as a
+single generated list comprehension. That saves calling a predicate
+function per item, but it is the same comprehension you would write by
+hand, so it runs no faster than one. The large speedup comes from
+mask(), which evaluates the expression over NumPy columns and returns
+a boolean array, so the whole test runs in vectorized code. Only
+comparisons, and/or/not, in/not in with literal collections, constants,
+names and is_int()/is_float() are allowed. For strings, is_int() is
+narrower than int(): after stripping whitespace it takes at most one
+sign followed by ASCII digits, with no '_' separators and no other
+Unicode digits, so that filter() and mask() always agree. Compiled
+filters are cached by their text."""
+
+import ast
+from functools import lru_cache
+
+def is_float(val):
+    try:
+        float(val)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def _is_int(val):
+    if isinstance(val, str):
+        body = val.strip()
+        if body[:1] in ('+', '-'):
+            body = body[1:]
+        return body.isascii() and body.isdigit()
+    try:
+        int(val)
+        return True
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+_FILTER_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp,
+                 ast.Not, ast.USub, ast.UAdd, ast.Compare, ast.Lt, ast.LtE,
+                 ast.Gt, ast.GtE, ast.Eq, ast.NotEq, ast.In, ast.NotIn,
+                 ast.Name, ast.Load, ast.Constant, ast.Tuple, ast.List,
+                 ast.Set, ast.Call)
+
+_FILTER_FUNCS = {'is_int': _is_int, 'is_float': is_float}
+
+class _RenameNames(ast.NodeTransformer):
+    def __init__(self, single):
+        self.single = single
+
+    def visit_Call(self, node):
+        node.args = [self.visit(arg) for arg in node.args]
+        node.func = ast.Name('_' + node.func.id, ast.Load())
+        return node
+
+    def visit_Name(self, node):
+        if self.single:
+            return ast.Name('_row', ast.Load())
+        return ast.Subscript(ast.Name('_row', ast.Load()),
+                             ast.Constant(node.id), ast.Load())
+
+class FilterExpr:
+    def __init__(self, text):
+        self.text = text
+        self.tree = ast.parse(text, mode='eval')
+        names = set()
+        funcs = set()
+        for node in ast.walk(self.tree):
+            if not isinstance(node, _FILTER_NODES):
+                raise ValueError('Unsupported syntax in filter: {}'.format(
+                                 type(node).__name__))
+            if isinstance(node, ast.Call):
+                if (not isinstance(node.func, ast.Name) or
+                        node.func.id not in _FILTER_FUNCS or
+                        len(node.args) != 1 or node.keywords):
+                    raise ValueError('Only is_int(x) and is_float(x) calls '
+                                     'are allowed')
+                funcs.add(node.func)
+            elif isinstance(node, ast.Name) and node not in funcs:
+                names.add(node.id)
+        self.names = names
+        self._filter_values = self._compile(single=True) if len(names) == 1 else None
+        self._filter_rows = self._compile(single=False)
+
+    def _compile(self, single):
+        cond = _RenameNames(single).visit(ast.parse(self.text, mode='eval')).body
+        tree = ast.parse('lambda _rows: [_row for _row in _rows if _cond]',
+                         mode='eval')
+        tree.body.body.generators[0].ifs = [cond]
+        ast.fix_missing_locations(tree)
+        env = {'_' + name: func for name, func in _FILTER_FUNCS.items()}
+        return eval(compile(tree, '<filter {!r}>'.format(self.text), 'eval'), env)
+
+    def filter(self, values):
+        'Filter plain values; the expression must use a single name'
+        if self._filter_values is None:
+            raise ValueError('filter() needs an expression with one name')
+        return self._filter_values(values)
+
+    def filter_rows(self, rows):
+        'Filter mappings, looking each name up as a key'
+        return self._filter_rows(rows)
+
+    def mask(self, columns):
+        'Boolean mask over a column (single name) or a dict of columns'
+        if not isinstance(columns, Mapping):
+            (name,) = self.names
+            columns = {name: columns}
+        columns = {name: np.asarray(col) for name, col in columns.items()}
+        return np.asarray(_np_eval(self.tree.body, columns), dtype=bool)
+
+def _np_is_int(arr):
+    if arr.dtype.kind in 'iub':
+        return np.ones(arr.shape, dtype=bool)
+    if arr.dtype.kind == 'f':
+        return np.isfinite(arr)
+    if arr.dtype.kind == 'U':
+        stripped = np.char.strip(arr)
+        body = np.char.lstrip(stripped, '+-')
+        signs = np.char.str_len(stripped) - np.char.str_len(body)
+        if not body.dtype.itemsize:
+            return np.zeros(arr.shape, dtype=bool)
+        # Code points as a trailing axis, to reject non-ASCII digits.
+        codes = np.ascontiguousarray(body).view(np.uint32).reshape(
+                body.shape + (-1,))
+        return ((signs <= 1) & np.char.isdigit(body) &
+                (codes < 128).all(axis=-1))
+    return np.fromiter(map(_is_int, arr), dtype=bool, count=len(arr))
+
+def _np_is_float(arr):
+    if arr.dtype.kind in 'iubf':
+        return np.ones(arr.shape, dtype=bool)
+    return np.fromiter(map(is_float, arr), dtype=bool, count=len(arr))
+
+_NP_FUNCS = {'is_int': _np_is_int, 'is_float': _np_is_float}
+
+_NP_COMPARE = {ast.Lt: np.less, ast.LtE: np.less_equal, ast.Gt: np.greater,
+               ast.GtE: np.greater_equal, ast.Eq: np.equal,
+               ast.NotEq: np.not_equal}
+
+def _np_eval(node, columns):
+    if isinstance(node, ast.Name):
+        return columns[node.id]
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        return [_np_eval(elt, columns) for elt in node.elts]
+    if isinstance(node, ast.UnaryOp):
+        value = _np_eval(node.operand, columns)
+        if isinstance(node.op, ast.Not):
+            return np.logical_not(value)
+        return -value if isinstance(node.op, ast.USub) else +value
+    if isinstance(node, ast.BoolOp):
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        result = _np_eval(node.values[0], columns)
+        for value in node.values[1:]:
+            result = combine(result, _np_eval(value, columns))
+        return result
+    if isinstance(node, ast.Call):
+        return _NP_FUNCS[node.func.id](np.asarray(_np_eval(node.args[0], columns)))
+    if isinstance(node, ast.Compare):
+        result = True
+        left = _np_eval(node.left, columns)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _np_eval(comparator, columns)
+            if isinstance(op, (ast.In, ast.NotIn)):
+                test = np.isin(left, right, invert=isinstance(op, ast.NotIn))
+            else:
+                test = _NP_COMPARE[type(op)](left, right)
+            result = np.logical_and(result, test)
+            left = right
+        return result
+    raise ValueError('Unsupported syntax in filter')
+
+@lru_cache(maxsize=256)
+def compile_filter(text):
+    return FilterExpr(text)
+
+mylist = [1, 4, -5, 10, -7, 2, 3, -1]
+pos = compile_filter('n > 0 and n not in (3, 10)')
+print(pos.filter(mylist))
+print(pos.mask(mylist))
+
+ivals = compile_filter('is_int(v)')
+print(ivals.filter(values), ivals.mask(values))
+
+print(compile_filter('count > 5').filter_rows(
+      [{'addr': addr, 'count': n} for addr, n in zip(addresses, counts)]))
+
+if __name__ == '__main__':
+    import time
+
+    n = 10000000
+    data = np.random.default_rng(0).integers(-1000, 1000, n)
+    values = data.tolist()
+    f = compile_filter('x > 0 and x < 500')
+
+    start = time.perf_counter()
+    [x for x in values if x > 0 and x < 500]
+    t_comp = time.perf_counter() - start
+
+    start = time.perf_counter()
+    f.filter(values)
+    t_fused = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data[f.mask(data)]
+    t_mask = time.perf_counter() - start
+    print('comprehension {:.3f}s  filter() {:.3f}s  mask() {:.3f}s'.format(
+          t_comp, t_fused, t_mask))
+
+    strings = np.where(data % 7 == 0, 'N/A', data.astype(str))[:1000000]
+    string_list = strings.tolist()
+    start = time.perf_counter()
+    list(filter(is_int, string_list))
+    t_filter = time.perf_counter() - start
+
+    start = time.perf_counter()
+    strings[compile_filter('is_int(s)').mask(strings)]
+    t_mask = time.perf_counter() - start
+    print('filter(is_int) {:.3f}s  mask() {:.3f}s'.format(t_filter, t_mask))
+
 # 1.17 Extracting a Subset of a Dictionary
 
 prices = {
@@ -708,6 +2630,127 @@ print(dict_to_stock(a))
 b = {'name': 'ACME', 'shares': 100, 'price': 123.45, 'date': '12/17/2012'}
 print(dict_to_stock(b))
 
+# Storing many namedtuple records as columns.
+
+"""A list of a million namedtuples is a million tuple objects plus the
+objects they hold. RecordBatch stores each field of the namedtuple as
+one NumPy array instead. batch.shares is the whole shares column, so
+compute_cost() becomes one vectorized dot product, and replace() is the
+column-wise version of _replace(). Iterating yields small views that
+read a row's fields on demand; record(i) builds a real namedtuple when
+one is needed."""
+
+import builtins
+import sys
+
+class _RecordView:
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __repr__(self):
+        fields = ', '.join('{}={!r}'.format(name, col.item(self._index))
+                           for name, col in self._columns.items())
+        return '{}({})'.format(type(self).__name__, fields)
+
+def _field_property(name):
+    return property(lambda self: self._columns[name].item(self._index))
+
+class RecordBatch:
+    def __init__(self, record_type, columns):
+        self.record_type = record_type
+        self._columns = {name: np.asarray(columns[name])
+                         for name in record_type._fields}
+        self._len = len(self._columns[record_type._fields[0]])
+        self._view = type(record_type.__name__ + 'View', (_RecordView,),
+                          {name: _field_property(name)
+                           for name in record_type._fields})
+
+    @classmethod
+    def from_records(cls, record_type, records, dtypes=None):
+        dtypes = dtypes or {}
+        columns = zip(*records) if records else [()] * len(record_type._fields)
+        return cls(record_type, {name: np.array(col, dtype=dtypes.get(name))
+                                 for name, col in zip(record_type._fields,
+                                                      columns)})
+
+    def __len__(self):
+        return self._len
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_columns'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __getitem__(self, index):
+        return self._view(self._columns, index)
+
+    def __iter__(self):
+        view, columns = self._view, self._columns
+        return (view(columns, i) for i in range(self._len))
+
+    def record(self, index):
+        return self.record_type(*(col.item(index)
+                                  for col in self._columns.values()))
+
+    def replace(self, **kwargs):
+        columns = dict(self._columns)
+        for name, value in kwargs.items():
+            columns[name] = np.broadcast_to(value, (self._len,)).copy()
+        return RecordBatch(self.record_type, columns)
+
+    @property
+    def nbytes(self):
+        # builtins.sum() because sum() was redefined in recipe 1.2.
+        return builtins.sum(col.nbytes for col in self._columns.values())
+
+def compute_cost_batch(batch):
+    return float(np.dot(batch.shares, batch.price))
+
+def records_nbytes(records):
+    'Approximate memory held by a list of tuples and their field values'
+    seen = set()
+    total = sys.getsizeof(records)
+    for rec in records:
+        total += sys.getsizeof(rec)
+        for value in rec:
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+Stock = namedtuple('Stock', ['name', 'shares', 'price'])
+
+holdings = [Stock('ACME', 100, 123.45), Stock('IBM', 50, 91.1),
+            Stock('AAPL', 75, 543.22)]
+batch = RecordBatch.from_records(Stock, holdings)
+
+print(compute_cost(holdings), compute_cost_batch(batch))
+print(batch[1], batch[1].shares, batch.record(1))
+print(list(batch.replace(shares=batch.shares * 2)))
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    rng = random.Random(0)
+    holdings = [Stock('S{}'.format(i % 5000), rng.randrange(1, 1000),
+                      rng.uniform(1, 500)) for i in range(1000000)]
+    batch = RecordBatch.from_records(Stock, holdings)
+    print('list of namedtuples: {:,} bytes'.format(records_nbytes(holdings)))
+    print('RecordBatch:         {:,} bytes'.format(batch.nbytes))
+
+    start = time.perf_counter()
+    compute_cost(holdings)
+    middle = time.perf_counter()
+    compute_cost_batch(batch)
+    end = time.perf_counter()
+    print('compute_cost {:.3f}s  compute_cost_batch {:.3f}s'.format(
+          middle - start, end - middle))
+
 
 # 1.19 Transforming and Reducing Data at the Same Time
 
@@ -766,6 +2809,188 @@ print(s)
 
 """The generator solution above is more memory-efficient."""
 
+# Computing many reductions in a single pass.
+
+"""Calling sum(), min() and any() separately walks the data once per
+reduction, and a one-shot generator can only be walked once anyway.
+Aggregator takes named reductions, optionally applied to a transformed
+value, generates one loop that updates all of them per item, and
+returns the results as a dict. mean and variance use Welford's method.
+Custom reductions are given as a Reducer. A NumPy array skips the loop
+and uses the array methods instead."""
+
+from collections import namedtuple
+import operator
+
+Reducer = namedtuple('Reducer', ['initial', 'step', 'result', 'vectorized'],
+                     defaults=(None, None))
+
+_missing = object()
+
+# Per reduction: initial state, loop body, result expression. {v} is the
+# value being reduced and {a}/{m} are the reduction's state variables.
+_REDUCTIONS = {
+    'sum':       ('{a} = 0', '{a} += {v}', '{a}'),
+    'count':     ('{a} = 0', '{a} += 1', '{a}'),
+    'min':       ('{a} = _missing',
+                  '_v = {v}\n'
+                  'if {a} is _missing or _v < {a}: {a} = _v',
+                  'None if {a} is _missing else {a}'),
+    'max':       ('{a} = _missing',
+                  '_v = {v}\n'
+                  'if {a} is _missing or _v > {a}: {a} = _v',
+                  'None if {a} is _missing else {a}'),
+    'any':       ('{a} = False', 'if not {a}: {a} = bool({v})', '{a}'),
+    'all':       ('{a} = True', 'if {a}: {a} = bool({v})', '{a}'),
+    'mean':      ('{a} = 0; {m} = 0.0',
+                  '{a} += 1; {m} += ({v} - {m}) / {a}',
+                  '{m} if {a} else None'),
+    'variance':  ('{a} = 0; {m} = 0.0; {q} = 0.0',
+                  '_v = {v}; {a} += 1; _d = _v - {m}; {m} += _d / {a}; '
+                  '{q} += _d * (_v - {m})',
+                  '{q} / ({a} - 1) if {a} > 1 else None'),
+    'pvariance': ('{a} = 0; {m} = 0.0; {q} = 0.0',
+                  '_v = {v}; {a} += 1; _d = _v - {m}; {m} += _d / {a}; '
+                  '{q} += _d * (_v - {m})',
+                  '{q} / {a} if {a} else None'),
+}
+
+_VECTORIZED = {
+    'sum': lambda v: v.sum().item(),
+    'count': lambda v: len(v),
+    'min': lambda v: v.min().item() if len(v) else None,
+    'max': lambda v: v.max().item() if len(v) else None,
+    'any': lambda v: bool(v.any()),
+    'all': lambda v: bool(v.all()),
+    'mean': lambda v: v.mean().item() if len(v) else None,
+    'variance': lambda v: v.var(ddof=1).item() if len(v) > 1 else None,
+    'pvariance': lambda v: v.var().item() if len(v) else None,
+}
+
+class Aggregator:
+    def __init__(self, **reductions):
+        '''
+        Each keyword names a result and gives a reduction: a name from
+        _REDUCTIONS, a Reducer, or a (reduction, func) tuple to reduce
+        func(x) instead of x. A third item, (reduction, func, vfunc),
+        gives the same transform for a whole NumPy array. Without it,
+        arrays with a func go through the item-by-item loop.
+        '''
+        self.reductions = {}
+        self._vfuncs = {}
+        for name, spec in reductions.items():
+            func = vfunc = None
+            if isinstance(spec, tuple) and not isinstance(spec, Reducer):
+                if len(spec) == 3:
+                    spec, func, vfunc = spec
+                else:
+                    spec, func = spec
+            if not isinstance(spec, Reducer) and spec not in _REDUCTIONS:
+                raise ValueError('Unknown reduction {!r}'.format(spec))
+            self.reductions[name] = (spec, func)
+            self._vfuncs[name] = vfunc
+        self._per_item_only = any(
+            func is not None and self._vfuncs[name] is None
+            for name, (_, func) in self.reductions.items())
+        self._loop = self._compile()
+
+    def _compile(self):
+        env = {'_missing': _missing}
+        init, body, result = [], [], []
+        for i, (name, (spec, func)) in enumerate(self.reductions.items()):
+            names = {'a': '_a{}'.format(i), 'm': '_m{}'.format(i),
+                     'q': '_q{}'.format(i)}
+            if func is None:
+                names['v'] = 'x'
+            else:
+                env['_f{}'.format(i)] = func
+                names['v'] = '_f{}(x)'.format(i)
+            if isinstance(spec, Reducer):
+                env['_step{}'.format(i)] = spec.step
+                env['_init{}'.format(i)] = spec.initial
+                env['_result{}'.format(i)] = spec.result or (lambda a: a)
+                init.append('{a} = _init{i}'.format(i=i, **names))
+                body.append('{a} = _step{i}({a}, {v})'.format(i=i, **names))
+                result.append('_result{i}({a})'.format(i=i, **names))
+            else:
+                i_src, b_src, r_src = _REDUCTIONS[spec]
+                init.append(i_src.format(**names))
+                body.append(b_src.format(**names))
+                result.append(r_src.format(**names))
+        lines = ['def _loop(items):']
+        lines += ['    ' + line for line in init]
+        lines.append('    for x in items:')
+        for stmt in body:
+            lines += ['        ' + line for line in stmt.split('\n')]
+        if not body:
+            lines.append('        pass')
+        lines.append('    return [{}]'.format(', '.join(result)))
+        exec('\n'.join(lines), env)
+        return env['_loop']
+
+    def __call__(self, items):
+        if isinstance(items, np.ndarray):
+            if not self._per_item_only:
+                return self._vectorized(items)
+            items = items.tolist()
+        return dict(zip(self.reductions, self._loop(items)))
+
+    def _vectorized(self, arr):
+        results = {}
+        for name, (spec, func) in self.reductions.items():
+            values = arr if func is None else self._vfuncs[name](arr)
+            if isinstance(spec, Reducer):
+                if spec.vectorized is not None:
+                    results[name] = spec.vectorized(values)
+                else:
+                    state = spec.initial
+                    for v in values.tolist():
+                        state = spec.step(state, v)
+                    results[name] = (spec.result or (lambda a: a))(state)
+            else:
+                results[name] = _VECTORIZED[spec](values)
+        return results
+
+stats = Aggregator(total='sum', squares=('sum', lambda x: x * x, np.square),
+                   smallest='min', largest='max', n='count', mean='mean',
+                   var='variance',
+                   product=Reducer(1, operator.mul, vectorized=lambda v: v.prod().item()))
+print(stats(x for x in [1, 2, 3, 4, 5]))
+print(stats(np.array([1, 2, 3, 4, 5])))
+
+files_stats = Aggregator(has_py=('any', lambda name: name.endswith('.py')),
+                         n='count')
+print(files_stats(os.listdir('.')))
+print(files_stats(np.array(os.listdir('.'))))
+
+if __name__ == '__main__':
+    import builtins
+    import random
+    import time
+
+    rng = random.Random(0)
+    data = [rng.random() for _ in range(1000000)]
+    agg = Aggregator(total='sum', smallest='min', largest='max', mean='mean',
+                     var='variance')
+
+    # builtins.sum() because sum() was redefined in recipe 1.2.
+    start = time.perf_counter()
+    total = builtins.sum(x for x in data)
+    min(x for x in data), max(x for x in data)
+    mean = total / len(data)
+    builtins.sum((x - mean) ** 2 for x in data) / (len(data) - 1)
+    t_separate = time.perf_counter() - start
+
+    start = time.perf_counter()
+    agg(iter(data))
+    t_fused = time.perf_counter() - start
+
+    start = time.perf_counter()
+    agg(np.array(data))
+    t_numpy = time.perf_counter() - start
+    print('separate passes {:.3f}s  Aggregator {:.3f}s  NumPy path {:.3f}s'.format(
+          t_separate, t_fused, t_numpy))
+
 
 # 1.20 Combining Multiple Mappings into a Single Mapping
 
@@ -853,3 +3078,163 @@ print(merged['x'])
 
 a['x'] = 42
 print(merged['x'])
+
+# Flattening a deep ChainMap for fast lookups.
+
+"""Every ChainMap lookup walks the maps until the key is found, which is
+O(depth). FlatChainMap keeps a merged dict of all the maps and answers
+lookups from it. To keep seeing writes made directly to the underlying
+dicts, as with a['x'] = 42 above, the maps must be VersionedDicts: on
+every change each one drops the flattened cache of every chain that
+contains it. This push invalidation takes the place of per-map version
+counters, because checking a version for every map on each lookup would
+make lookups O(depth) again. A chain holding any other kind of mapping
+just falls back to normal ChainMap lookups. Like the maps themselves,
+the maps list should not be changed in place without calling
+invalidate()."""
+
+import weakref
+
+class _FlatCache:
+    __slots__ = ('flat', '__weakref__')
+
+    def __init__(self):
+        self.flat = None
+
+class VersionedDict(dict):
+    __slots__ = ('_caches',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._caches = weakref.WeakSet()
+
+    def _changed(self):
+        for cache in self._caches:
+            cache.flat = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def __ior__(self, other):
+        super().__ior__(other)
+        self._changed()
+        return self
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return super().__getitem__(key)
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._changed()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+class FlatChainMap(ChainMap):
+    def __init__(self, *maps):
+        super().__init__(*maps)
+        self._cache = _FlatCache()
+        self._cacheable = all(isinstance(m, VersionedDict) for m in self.maps)
+        if self._cacheable:
+            for m in self.maps:
+                m._caches.add(self._cache)
+
+    def invalidate(self):
+        self.__init__(*self.maps)
+
+    def _flat(self):
+        flat = self._cache.flat
+        if flat is None:
+            flat = {}
+            for m in reversed(self.maps):
+                flat.update(m)
+            self._cache.flat = flat
+        return flat
+
+    def __getitem__(self, key):
+        if not self._cacheable:
+            return super().__getitem__(key)
+        try:
+            return self._flat()[key]
+        except KeyError:
+            return self.__missing__(key)
+
+    def get(self, key, default=None):
+        if not self._cacheable:
+            return super().get(key, default)
+        return self._flat().get(key, default)
+
+    def __contains__(self, key):
+        if not self._cacheable:
+            return super().__contains__(key)
+        return key in self._flat()
+
+    def __len__(self):
+        if not self._cacheable:
+            return super().__len__()
+        return len(self._flat())
+
+    def __iter__(self):
+        if not self._cacheable:
+            return super().__iter__()
+        return iter(self._flat())
+
+    def new_child(self, m=None, **kwargs):
+        if m is None:
+            m = VersionedDict(kwargs)
+        elif kwargs:
+            m.update(kwargs)
+        return self.__class__(m, *self.maps)
+
+a = VersionedDict(x=1, z=3)
+b = VersionedDict(y=2, z=4)
+
+merged = FlatChainMap(a, b)
+print(merged['x'])
+
+a['x'] = 42
+print(merged['x'])
+
+values = FlatChainMap(VersionedDict())
+values['x'] = 1
+values = values.new_child()
+values['x'] = 2
+print(values['x'], values.parents['x'])
+
+# Lookup benchmark across chain depths.
+
+import time
+
+def bench_chainmap(depths=(1, 5, 20, 50), nlookups=200000):
+    for depth in depths:
+        layers = [VersionedDict({'k{}'.format(i): i}) for i in range(depth)]
+        plain = ChainMap(*layers)
+        flat = FlatChainMap(*layers)
+        key = 'k{}'.format(depth - 1)  # Only found in the last layer
+        for label, m in [('ChainMap', plain), ('FlatChainMap', flat)]:
+            start = time.perf_counter()
+            for _ in range(nlookups):
+                m[key]
+            print('depth {:>2d} {:>13s}: {:.3f}s'.format(
+                  depth, label, time.perf_counter() - start))
+
+if __name__ == '__main__':
+    bench_chainmap()
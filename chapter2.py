@@ -125,6 +125,178 @@ from fnmatch import fnmatchcase
 print([addr for addr in addresses if fnmatchcase(addr, '* ST')])
 print([addr for addr in addresses if fnmatchcase(addr, '54[0-9][0-9] *CLARK*')])
 
+# Matching one name against thousands of patterns.
+
+"""Calling fnmatchcase() for each pattern costs time proportional to the
+number of patterns. PatternSet sorts them by what they need: plain
+names go in a dict, and every other pattern is filed under the longer
+of its literal prefix and literal suffix. A name is then checked by
+slicing off its tail and head at the few lengths those literals come in
+and looking them up. Only the candidates found that way, plus patterns
+with no literal ends at all such as '*foo*', fall back to a regex.
+Pattern ids are positions in the original list."""
+
+import os
+import re
+from fnmatch import translate
+
+class PatternSet:
+    _SPECIAL = re.compile(r'[*?\[\]]')
+
+    def __init__(self, patterns, normcase=False):
+        self.patterns = list(patterns)
+        self._normcase = os.path.normcase if normcase else None
+        self._exact = {}
+        self._suffixes = {}
+        self._prefixes = {}
+        self._rest = []
+        for pat_id, pat in enumerate(self.patterns):
+            if normcase:
+                pat = os.path.normcase(pat)
+            specials = [m.start() for m in self._SPECIAL.finditer(pat)]
+            if not specials:
+                self._exact.setdefault(pat, []).append(pat_id)
+                continue
+            prefix = pat[:specials[0]]
+            suffix = pat[specials[-1] + 1:]
+            if pat == prefix + '*' or pat == '*' + suffix:
+                check = None
+            else:
+                check = re.compile(translate(pat)).match
+            # File under the longer literal: it is the more selective.
+            if suffix and len(suffix) >= len(prefix):
+                self._suffixes.setdefault(suffix, []).append((pat_id, check))
+            elif prefix:
+                self._prefixes.setdefault(prefix, []).append((pat_id, check))
+            else:
+                self._rest.append((pat_id, check))
+        self._suffix_lens = sorted({len(s) for s in self._suffixes})
+        self._prefix_lens = sorted({len(p) for p in self._prefixes})
+        # One alternation over the patterns without literal ends, with a
+        # table from group number to pattern id as in Lexer.
+        parts = []
+        group_ids = [None]
+        for pat_id, _ in self._rest:
+            translated = translate(self.patterns[pat_id] if not normcase
+                                   else os.path.normcase(self.patterns[pat_id]))
+            parts.append('({})'.format(translated))
+            group_ids.append(pat_id)
+            group_ids.extend([None] * re.compile(translated).groups)
+        self._rest_match = re.compile('|'.join(parts)).match if parts else None
+        self._rest_ids = group_ids
+
+    def _candidates(self, name):
+        size = len(name)
+        get = self._suffixes.get
+        for n in self._suffix_lens:
+            if n > size:
+                break
+            entries = get(name[size - n:])
+            if entries:
+                yield from entries
+        get = self._prefixes.get
+        for n in self._prefix_lens:
+            if n > size:
+                break
+            entries = get(name[:n])
+            if entries:
+                yield from entries
+
+    def match_any(self, name):
+        'Return the id of a pattern matching name, or None'
+        if self._normcase:
+            name = self._normcase(name)
+        ids = self._exact.get(name)
+        if ids:
+            return ids[0]
+        size = len(name)
+        get = self._suffixes.get
+        for n in self._suffix_lens:
+            if n > size:
+                break
+            for pat_id, check in get(name[size - n:], ()):
+                if check is None or check(name):
+                    return pat_id
+        get = self._prefixes.get
+        for n in self._prefix_lens:
+            if n > size:
+                break
+            for pat_id, check in get(name[:n], ()):
+                if check is None or check(name):
+                    return pat_id
+        if self._rest_match:
+            m = self._rest_match(name)
+            if m:
+                return self._rest_ids[m.lastindex]
+        return None
+
+    def match_all(self, name):
+        'Return the sorted ids of all patterns matching name'
+        if self._normcase:
+            name = self._normcase(name)
+        ids = list(self._exact.get(name, ()))
+        for pat_id, check in self._candidates(name):
+            if check is None or check(name):
+                ids.append(pat_id)
+        for pat_id, check in self._rest:
+            if check is None or check(name):
+                ids.append(pat_id)
+        ids.sort()
+        return ids
+
+    def filter(self, names):
+        'Return the names that match at least one pattern'
+        match_any = self.match_any
+        return [name for name in names if match_any(name) is not None]
+
+rules = PatternSet(['*.csv', 'Dat*', 'config.ini', 'Dat[0-9]*.csv', '*oo*'])
+print(rules.match_any('Dat45.csv'))
+print(rules.match_all('Dat45.csv'))
+print(rules.match_all('foo.py'))
+print(rules.filter(names))
+print(PatternSet(['* ST', '54[0-9][0-9] *CLARK*']).filter(addresses))
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    rnd = random.Random(0)
+    words = ['report', 'data', 'img', 'backup', 'log', 'test', 'build', 'cache']
+    exts = ['txt', 'csv', 'py', 'json', 'log', 'gz', 'png', 'ini']
+    patterns = []
+    for i in range(5000):
+        word = '{}{}'.format(rnd.choice(words), i)
+        kind = i % 5
+        if kind == 0:
+            patterns.append('{}.{}'.format(word, rnd.choice(exts)))
+        elif kind == 1:
+            patterns.append('*_{}.{}'.format(word, rnd.choice(exts)))
+        elif kind == 2:
+            patterns.append('{}/*'.format(word))
+        elif kind == 3:
+            patterns.append('{}_[0-9]*.{}'.format(word, rnd.choice(exts)))
+        else:
+            patterns.append('{}*.?{}'.format(word, rnd.choice(exts)))
+    patterns.extend(['*~', '*tmp*', '.*'])
+    test_names = ['{}{}_{}.{}'.format(rnd.choice(words), rnd.randrange(6000),
+                                      rnd.randrange(100), rnd.choice(exts))
+                  for _ in range(100000)]
+
+    rules = PatternSet(patterns)
+    start = time.perf_counter()
+    matched = rules.filter(test_names)
+    t_set = (time.perf_counter() - start) / len(test_names)
+
+    sample = test_names[:200]
+    start = time.perf_counter()
+    expected = [name for name in sample
+                if any(fnmatchcase(name, pat) for pat in patterns)]
+    t_loop = (time.perf_counter() - start) / len(sample)
+    assert expected == rules.filter(sample)
+    print('{} patterns: fnmatchcase loop {:.1f} us/name  '
+          'PatternSet {:.2f} us/name'.format(len(patterns), t_loop * 1e6,
+                                             t_set * 1e6))
+
 
 # 2.4 Matching and Searching for Text Patterns
 
@@ -296,6 +468,150 @@ def matchcase(word):
         return replace
         print(re.sub('python', matchcase('snake'), text, flags=re.IGNORECASE))
 
+# Replacing many words in a single pass.
+
+"""Applying a dictionary of replacements with one re.sub() per key scans
+the text once per key. Replacer builds one pattern for all the keys and
+looks the replacement up in the dict for each match. A flat 'a|b|c'
+alternation makes the regex engine try every key at every position, so
+the keys are first merged into a trie and the pattern is written out
+from that ('python|pyramid|pythonic' becomes 'py(?:thon(?:ic)?|ramid)').
+Longer keys win over their prefixes. With preserve_case the keys match
+in any case and the replacement copies the case of the matched text,
+as matchcase() was meant to. Keys and values can be str or bytes, but
+not a mix of the two."""
+
+class Replacer:
+    def __init__(self, mapping, ignore_case=False, preserve_case=False,
+                 whole_words=False):
+        if not mapping:
+            raise ValueError('Replacer needs at least one key')
+        self.ignore_case = ignore_case or preserve_case
+        self.preserve_case = preserve_case
+        keys = list(mapping)
+        self._is_bytes = isinstance(keys[0], bytes)
+        if self.ignore_case:
+            self._lookup = {key.lower(): value for key, value in mapping.items()}
+        else:
+            self._lookup = dict(mapping)
+        trie = {}
+        for key in self._lookup:
+            if not key:
+                raise ValueError('Replacer keys must not be empty')
+            if isinstance(key, bytes) != self._is_bytes:
+                raise TypeError('Replacer keys must be all str or all bytes')
+            if self._is_bytes:
+                key = key.decode('latin-1')
+            node = trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[None] = True
+        pattern = self._trie_pattern(trie)
+        if whole_words:
+            pattern = r'\b(?:{})\b'.format(pattern)
+        flags = re.IGNORECASE if self.ignore_case else 0
+        if self._is_bytes:
+            # re.escape() leaves non-ASCII characters alone, so going
+            # through latin-1 maps every byte back to itself.
+            pattern = pattern.encode('latin-1')
+        self.pattern = re.compile(pattern, flags)
+
+    @classmethod
+    def _trie_pattern(cls, node):
+        alternatives = []
+        chars = []
+        for ch in sorted(key for key in node if key is not None):
+            child = node[ch]
+            if len(child) == 1 and None in child:
+                chars.append(re.escape(ch))
+            else:
+                alternatives.append(re.escape(ch) + cls._trie_pattern(child))
+        if len(chars) == 1:
+            alternatives.append(chars[0])
+        elif chars:
+            alternatives.append('[{}]'.format(''.join(chars)))
+        if len(alternatives) == 1:
+            pattern = alternatives[0]
+        else:
+            pattern = '(?:{})'.format('|'.join(alternatives))
+        if None in node:
+            pattern = '(?:{})?'.format(pattern)
+        return pattern
+
+    @staticmethod
+    def _match_case(found, word):
+        if found.isupper():
+            return word.upper()
+        elif found.islower():
+            return word.lower()
+        elif found[:1].isupper():
+            return word.capitalize()
+        else:
+            return word
+
+    def _replacement(self, m):
+        found = m.group()
+        if not self.ignore_case:
+            return self._lookup[found]
+        word = self._lookup.get(found.lower())
+        if word is None:
+            # re.IGNORECASE and lower() disagree on a few characters.
+            return found
+        if self.preserve_case:
+            return self._match_case(found, word)
+        return word
+
+    def subn(self, text):
+        'Return (new_text, number_of_replacements)'
+        if not self.ignore_case:
+            lookup = self._lookup
+            return self.pattern.subn(lambda m: lookup[m.group()], text)
+        return self.pattern.subn(self._replacement, text)
+
+    def replace(self, text):
+        return self.subn(text)[0]
+
+text = 'UPPER PYTHON, lower python, Mixed Python'
+snakes = Replacer({'python': 'snake', 'upper': 'top'}, preserve_case=True)
+print(snakes.replace(text))
+print(Replacer({'yeah': 'yep', 'no': 'nope'}, whole_words=True).subn(
+      'yeah, but no, but yeah, but no, but yeah, not now'))
+print(Replacer({b'python': b'snake', b'py': b'PY'}).replace(b'python.py'))
+print(Replacer({'python': 'x', 'pyramid': 'y', 'pythonic': 'z'}).pattern)
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    rnd = random.Random(0)
+    mapping = {'word{}'.format(i): 'WORD{}'.format(i) for i in range(10000)}
+    keys = list(mapping)
+    text = ' '.join(rnd.choice(keys) if rnd.random() < 0.3 else 'filler'
+                    for _ in range(20000))
+
+    start = time.perf_counter()
+    replacer = Replacer(mapping, whole_words=True)
+    t_build = time.perf_counter() - start
+    start = time.perf_counter()
+    result = replacer.replace(text)
+    t_trie = time.perf_counter() - start
+
+    flat = re.compile(r'\b(?:{})\b'.format('|'.join(
+        map(re.escape, sorted(mapping, key=len, reverse=True)))))
+    start = time.perf_counter()
+    assert flat.sub(lambda m: mapping[m.group()], text) == result
+    t_flat = time.perf_counter() - start
+
+    # One pass per key, timed over the first 500 keys only.
+    start = time.perf_counter()
+    partial = text
+    for key in keys[:500]:
+        partial = re.sub(r'\b{}\b'.format(key), mapping[key], partial)
+    t_loop = (time.perf_counter() - start) * len(keys) / 500
+    print('{} keys, {} chars: re.sub per key ~{:.1f}s  flat alternation '
+          '{:.3f}s  Replacer {:.3f}s (+{:.3f}s to build)'.format(
+          len(keys), len(text), t_loop, t_flat, t_trie, t_build))
+
 
 # 2.7 Specifying a Regular Expression for the Shortest Match
 
@@ -385,6 +701,109 @@ print(unicodedata.normalize('NFKC', s))
 t1 = unicodedata.normalize('NFD', s1)
 print(''.join(c for c in t1 if not unicodedata.combining(c)))
 
+# Normalizing many mostly-ASCII strings.
+
+"""unicodedata.normalize() already returns a string that passes a quick
+check unchanged, which makes NFC and NFKC fast on text that is mostly
+composed already. Going through a cache only slows those forms down,
+so normalize_text() passes them straight through. The decomposing
+forms NFD and NFKD really do rebuild every accented string. For them,
+ASCII strings are returned after an isascii() test and the rest go
+through a bounded lru_cache. That only gains anything when the same
+non-ASCII values come up again and again, as in a column of names.
+strip_accents() uses the combining-character
+translate trick from 2.12, except that the table is filled in lazily
+by __missing__ and maps each precomposed character straight to its
+stripped decomposition ('ñ' -> 'n'). One translate() call then
+does the work of normalize('NFD') plus the filter. normalize_all() and
+strip_accents_all() take a whole list or column."""
+
+from functools import lru_cache
+
+@lru_cache(maxsize=4096)
+def _normalize_cached(form, s):
+    return unicodedata.normalize(form, s)
+
+def normalize_text(s, form='NFC'):
+    if form in ('NFC', 'NFKC'):
+        return unicodedata.normalize(form, s)
+    if s.isascii():
+        return s
+    return _normalize_cached(form, s)
+
+class _StripAccentsTable(dict):
+    def __missing__(self, c):
+        ch = chr(c)
+        stripped = ''.join(d for d in unicodedata.normalize('NFD', ch)
+                           if not unicodedata.combining(d))
+        # Returning the ordinal itself leaves the character alone.
+        value = c if stripped == ch else stripped
+        self[c] = value
+        return value
+
+_strip_accents_table = _StripAccentsTable()
+
+def strip_accents(s):
+    if s.isascii():
+        return s
+    return s.translate(_strip_accents_table)
+
+def normalize_all(values, form='NFC'):
+    'Normalize every string in values, returning a list'
+    if form in ('NFC', 'NFKC'):
+        normalize = unicodedata.normalize
+        return [normalize(form, s) for s in values]
+    cached = _normalize_cached
+    return [s if s.isascii() else cached(form, s) for s in values]
+
+def strip_accents_all(values):
+    'Strip accents from every string in values, returning a list'
+    table = _strip_accents_table
+    return [s if s.isascii() else s.translate(table) for s in values]
+
+print(normalize_text(s2) == normalize_text(s1))
+print(ascii(normalize_text(s1, 'NFD')))
+print(strip_accents(s1), strip_accents(s2))
+print(normalize_all(['Spicy', s2, 'ﬁle'], 'NFKC'))
+print(strip_accents_all(['Jalapeño', 'Crème brûlée', 'plain']))
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    rnd = random.Random(0)
+    accented = ['José', 'Björk', 'François', 'Zoë',
+                'Renée', 'Señor', 'Müller', 'Jalapeño']
+    plain = ['Smith', 'Jones', 'Taylor', 'Brown', 'Wilson', 'Davies']
+    names = ['{} {}'.format(rnd.choice(plain), i % 500) for i in range(500)]
+    names += ['{} {}'.format(rnd.choice(accented), i % 50) for i in range(50)]
+    column = [rnd.choice(names) for _ in range(300000)]
+
+    def timed(func):
+        start = time.perf_counter()
+        result = func()
+        return result, len(column) / (time.perf_counter() - start)
+
+    # The cache helps NFD on repeated accented values.
+    column = [rnd.choice(names[500:]) for _ in range(300000)]
+    expected, per_call = timed(lambda: [unicodedata.normalize('NFD', s)
+                                        for s in column])
+    result, bulk = timed(lambda: normalize_all(column, 'NFD'))
+    assert result == expected
+    print('NFD, accented: normalize() {:,.0f} strings/sec  normalize_all() '
+          '{:,.0f} strings/sec'.format(per_call, bulk))
+    column = [rnd.choice(names) for _ in range(300000)]
+
+    def strip_loop():
+        return [''.join(c for c in unicodedata.normalize('NFD', s)
+                        if not unicodedata.combining(c)) for s in column]
+
+    expected, per_call = timed(strip_loop)
+    result, bulk = timed(lambda: strip_accents_all(column))
+    assert result == expected
+    print('strip accents: NFD + combining() {:,.0f} strings/sec  '
+          'strip_accents_all() {:,.0f} strings/sec'.format(per_call, bulk))
+
 
 # 2.10 Working with Unicode Characters in Regular Expressions
 
@@ -497,6 +916,149 @@ def clean_spaces(s):
     s = s.replace('\f', ' ')
     return s
     print(s)
+
+# Precompiled sanitizing pipelines.
+
+"""The cleanups above each make a new string: translate(remap), then
+normalize(), then translate(cmb_chrs), then encode/decode. Sanitizer
+takes the steps as a list. A step is a remap-style dict, 'strip_accents',
+'digits' (the digitmap), 'ascii' (what encode('ascii', 'ignore') drops),
+or a normal form such as 'NFKC'. Consecutive character steps are
+composed into one translation table that is filled in lazily, one
+character at a time, so only the characters that actually turn up get
+computed. That replaces building cmb_chrs and digitmap over all of
+sys.maxunicode. A normal form works on runs of characters and so
+starts a new pass. If every step leaves ASCII alone, ASCII strings are
+returned unchanged."""
+
+class _ComposedTable(dict):
+    def __init__(self, funcs):
+        self._funcs = funcs
+
+    def __missing__(self, c):
+        ch = chr(c)
+        s = ch
+        for func in self._funcs:
+            s = ''.join(func(x) for x in s)
+        value = c if s == ch else s
+        self[c] = value
+        return value
+
+def _map_step(mapping):
+    table = {}
+    for key, value in mapping.items():
+        if isinstance(key, str):
+            key = ord(key)
+        if value is None:
+            value = ''
+        elif isinstance(value, int):
+            value = chr(value)
+        table[key] = value
+    return lambda ch: table.get(ord(ch), ch)
+
+def _strip_accents_step(ch):
+    return ''.join(d for d in unicodedata.normalize('NFD', ch)
+                   if not unicodedata.combining(d))
+
+def _digits_step(ch):
+    if unicodedata.category(ch) == 'Nd':
+        return str(unicodedata.digit(ch))
+    return ch
+
+def _ascii_step(ch):
+    return ch if ch.isascii() else ''
+
+class Sanitizer:
+    _char_steps = {
+        'strip_accents': _strip_accents_step,
+        'digits': _digits_step,
+        'ascii': _ascii_step,
+    }
+    _forms = {'NFC', 'NFD', 'NFKC', 'NFKD'}
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self._passes = []
+        pending = []
+        for step in self.steps:
+            if isinstance(step, dict):
+                pending.append(_map_step(step))
+            elif step in self._char_steps:
+                pending.append(self._char_steps[step])
+            elif step in self._forms:
+                self._add_table(pending)
+                pending = []
+                self._passes.append(
+                    lambda s, form=step: unicodedata.normalize(form, s))
+            else:
+                raise ValueError('Unknown sanitizer step {!r}'.format(step))
+        self._add_table(pending)
+        if len(self._passes) == 1:
+            self.clean = self._passes[0]
+
+    def _add_table(self, funcs):
+        if not funcs:
+            return
+        table = _ComposedTable(funcs)
+        if all(table[c] == c for c in range(128)):
+            self._passes.append(
+                lambda s: s if s.isascii() else s.translate(table))
+        else:
+            self._passes.append(lambda s: s.translate(table))
+
+    def clean(self, s):
+        for step in self._passes:
+            s = step(s)
+        return s
+
+    def clean_lines(self, lines):
+        'Generate the cleaned version of each line'
+        clean = self.clean
+        for line in lines:
+            yield clean(line)
+
+    def clean_file(self, filename, encoding='utf-8'):
+        'Generate the cleaned lines of a text file'
+        with open(filename, 'rt', encoding=encoding) as f:
+            yield from self.clean_lines(f)
+
+sanitizer = Sanitizer([remap, 'strip_accents', 'digits', 'ascii'])
+print(sanitizer.clean(s))
+print(sanitizer.clean('١٢٣ résumé'))
+print(Sanitizer(['NFKC', 'strip_accents']).clean('ﬁancée'))
+
+if __name__ == '__main__':
+    import re
+    import time
+
+    lines = ['pýtĥöñ\fis\tawesome ١٢٣\r\n',
+             'plain ascii line with\ttabs\r\n',
+             'Crème brûlée costs ३० rupees\r\n'] * 100000
+
+    def timed(label, func):
+        start = time.perf_counter()
+        result = [func(line) for line in lines]
+        print('{:<22}{:.3f}s'.format(label, time.perf_counter() - start))
+        return result
+
+    def chained(line):
+        line = line.translate(remap)
+        line = unicodedata.normalize('NFD', line).translate(cmb_chrs)
+        line = line.translate(digitmap)
+        return line.encode('ascii', 'ignore').decode('ascii')
+
+    odd_pat = re.compile(r'[^\x00-\x7f]|[\t\f\r]')
+    odd_cache = {}
+
+    def regex_sub(line):
+        return odd_pat.sub(lambda m: odd_cache.get(m.group())
+                           or odd_cache.setdefault(m.group(),
+                                                   sanitizer.clean(m.group())),
+                           line)
+
+    expected = timed('chained translate', chained)
+    assert timed('regex sub', regex_sub) == expected
+    assert timed('Sanitizer', sanitizer.clean) == expected
     
 # 2.13 Aligning Text Strings
 
@@ -763,6 +1325,170 @@ master_pat = re.compile('|'.join([PRINT, NAME]))
 
 for tok in generate_tokens(master_pat, 'printer'):
     print(tok)
+
+# A cached, table-driven lexer.
+
+"""generate_tokens() makes a Token namedtuple and looks up m.lastgroup
+by name for every match. make_lexer() takes (NAME, regex) pairs, wraps
+each regex in one numbered group of a master pattern and keeps a table
+from group number to type id. Tokens come out as plain
+(type_id, start, end) tuples, or as one flat array of them, and the
+types in skip (such as WS) are dropped. Lexers are cached by their
+spec. Characters that match no rule raise SyntaxError instead of
+silently ending the scan."""
+
+from array import array
+from functools import lru_cache
+
+class Lexer:
+    def __init__(self, spec, skip=()):
+        self.names = tuple(name for name, _ in spec)
+        self.type_ids = {name: i for i, name in enumerate(self.names)}
+        parts = []
+        group_types = [None]
+        for type_id, (name, regex) in enumerate(spec):
+            parts.append('({})'.format(regex))
+            group_types.append(type_id)
+            # Groups inside the regex itself are numbered after ours.
+            group_types.extend([None] * re.compile(regex).groups)
+        self.pattern = re.compile('|'.join(parts))
+        self._group_types = group_types
+        self._skip = frozenset(self.type_ids[name] for name in skip)
+
+    def tokenize(self, text):
+        'Generate (type_id, start, end) for each token'
+        group_types = self._group_types
+        skip = self._skip
+        match = self.pattern.match
+        pos = 0
+        end = len(text)
+        while pos < end:
+            m = match(text, pos)
+            if m is None or m.end() == pos:
+                raise SyntaxError('Illegal character {!r} at {}'.format(
+                                  text[pos], pos))
+            type_id = group_types[m.lastindex]
+            if type_id not in skip:
+                yield type_id, pos, m.end()
+            pos = m.end()
+
+    def tokenize_array(self, text):
+        'Return all tokens as a flat array of type_id, start, end triples'
+        tokens = array('q')
+        for tok in self.tokenize(text):
+            tokens.extend(tok)
+        return tokens
+
+@lru_cache(maxsize=64)
+def _make_lexer(spec, skip):
+    return Lexer(spec, skip)
+
+def make_lexer(spec, skip=()):
+    return _make_lexer(tuple(spec), frozenset(skip))
+
+spec = [('NAME', r'[a-zA-Z_][a-zA-Z_0-9]*'), ('NUM', r'\d+'), ('PLUS', r'\+'),
+        ('TIMES', r'\*'), ('EQ', r'='), ('WS', r'\s+')]
+
+lexer = make_lexer(spec, skip={'WS'})
+text = 'foo = 23 + 42 * 10'
+for type_id, start, end in lexer.tokenize(text):
+    print(lexer.names[type_id], text[start:end])
+
+print(lexer.tokenize_array('foo = 42'))
+
+if __name__ == '__main__':
+    import time
+
+    master_pat = re.compile('|'.join('(?P<{}>{})'.format(name, regex)
+                                     for name, regex in spec))
+    text = 'foo = 23 + 42 * 10 ' * 100000
+    ntokens = len(lexer.tokenize_array(text)) // 3
+
+    start = time.perf_counter()
+    for tok in generate_tokens(master_pat, text):
+        if tok.type != 'WS':
+            pass
+    t_generate = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for tok in lexer.tokenize(text):
+        pass
+    t_lexer = time.perf_counter() - start
+    print('generate_tokens {:,.0f} tokens/sec  Lexer {:,.0f} tokens/sec'.format(
+          ntokens / t_generate, ntokens / t_lexer))
+
+# Tokenizing a stream of chunks.
+
+"""generate_tokens() needs the whole text as one string. The streaming
+version takes any iterator of chunks (file reads, socket recvs). A
+match that runs into the end of the buffered text could still grow
+when the next chunk arrives, as with '<' followed by '=', so it is held
+back and rescanned with more data. Only that unfinished tail is kept
+between chunks, so memory is bounded by the chunk size plus the longest
+token; a token longer than max_token raises SyntaxError. Since a match
+that fails at the end of the buffer could still succeed with more text,
+a bad character is only reported once max_token characters have piled
+up behind it, or when the stream ends. Patterns whose lookaheads peek
+past the end of a token are not supported."""
+
+import codecs
+from functools import partial
+
+def _illegal_char(buf, pos, offset):
+    return SyntaxError('Illegal character {!r} at {}'.format(buf[pos],
+                                                              offset + pos))
+
+def generate_tokens_stream(pat, chunks, max_token=1 << 20):
+    buf = ''
+    offset = 0          # Stream position of buf[0]
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            m = pat.match(buf, pos)
+            if m is None or m.end() == end:
+                # Might match differently once more text arrives.
+                break
+            if m.end() == pos:
+                raise _illegal_char(buf, pos, offset)
+            yield Token(m.lastgroup, m.group())
+            pos = m.end()
+        buf = buf[pos:]
+        offset += pos
+        if len(buf) > max_token:
+            # No token can be this long, so if nothing matches here
+            # more text won't help: the first character is bad.
+            if pat.match(buf) is None:
+                raise _illegal_char(buf, 0, offset)
+            raise SyntaxError('Token longer than {} characters'.format(max_token))
+    # Scan what is left here: 2.19 rebinds generate_tokens() later on.
+    pos = 0
+    while pos < len(buf):
+        m = pat.match(buf, pos)
+        if m is None or m.end() == pos:
+            raise _illegal_char(buf, pos, offset)
+        yield Token(m.lastgroup, m.group())
+        pos = m.end()
+
+def file_chunks(f, size=65536):
+    return iter(partial(f.read, size), '')
+
+def socket_chunks(sock, size=65536, encoding='utf-8'):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for data in iter(partial(sock.recv, size), b''):
+        yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
+
+LT = r'(?P<LT><)'
+LE = r'(?P<LE><=)'
+NUM = r'(?P<NUM>\d+)'
+WS = r'(?P<WS>\s+)'
+stream_pat = re.compile('|'.join([LE, LT, NUM, WS]))
+
+chunks = ['12 <', '= 3', '45 < 6']
+print(list(generate_tokens_stream(stream_pat, chunks)))
+print(list(generate_tokens(stream_pat, ''.join(chunks))))
     
     
 # 2.19 Writing a Simple Recursive Descent Parser
@@ -918,6 +1644,446 @@ print(e.parse('2 + 3 * 4'))
 print(e.parse('2 + (3 + 4) * 5'))
 print(e.parse('2 + 3 + 4'))
 
+# Compiling expressions with variables.
+
+"""parse() tokenizes and walks the grammar every time it is called.
+ExpressionCompiler uses the same grammar, plus NAME for variables, but
+each rule returns Python source instead of a value. compile_expression()
+turns that source into a function of the variables, and caches it by
+expression text, so a formula is parsed once and then runs at the speed
+of ordinary Python code. The function only uses +, -, *, / on its
+arguments, so it works just as well on NumPy arrays."""
+
+from functools import lru_cache
+
+NAME = r'(?P<NAME>[a-zA-Z_][a-zA-Z_0-9]*)'
+
+expr_pat = re.compile('|'.join([NUM, NAME, PLUS, MINUS, TIMES,
+                                DIVIDE, LPAREN, RPAREN, WS]))
+
+def generate_expr_tokens(text):
+    scanner = expr_pat.scanner(text)
+    for m in iter(scanner.match, None):
+        tok = Token(m.lastgroup, m.group())
+        if tok.type != 'WS':
+            yield tok
+
+class ExpressionCompiler(ExpressionEvaluator):
+    def parse(self, text):
+        'Return (source, names) for the expression'
+        self.tokens = generate_expr_tokens(text)
+        self.tok = None
+        self.nexttok = None
+        self.names = set()
+        self._advance()
+        source = self.expr()
+        if self.nexttok is not None:
+            raise SyntaxError('Unexpected ' + self.nexttok.type)
+        return source, self.names
+
+    def expr(self):
+        "expression ::= term { ('+'|'-') term }*"
+        exprval = self.term()
+        while self._accept('PLUS') or self._accept('MINUS'):
+            op = '+' if self.tok.type == 'PLUS' else '-'
+            exprval = '({} {} {})'.format(exprval, op, self.term())
+        return exprval
+
+    def term(self):
+        "term ::= factor { ('*'|'/') factor }*"
+        termval = self.factor()
+        while self._accept('TIMES') or self._accept('DIVIDE'):
+            op = '*' if self.tok.type == 'TIMES' else '/'
+            termval = '({} {} {})'.format(termval, op, self.factor())
+        return termval
+
+    def factor(self):
+        "factor ::= NUM | NAME | ( expr )"
+        if self._accept('NUM'):
+            # Not the token text: '007' is not a valid Python literal.
+            return repr(int(self.tok.value))
+        elif self._accept('NAME'):
+            self.names.add(self.tok.value)
+            return self.tok.value
+        elif self._accept('LPAREN'):
+            exprval = self.expr()
+            self._expect('RPAREN')
+            return exprval
+        else:
+            raise SyntaxError('Expected NUMBER, NAME or LPAREN')
+
+class CompiledExpression:
+    def __init__(self, text):
+        source, names = ExpressionCompiler().parse(text)
+        self.text = text
+        self.source = source
+        self.names = tuple(sorted(names))
+        code = compile('lambda {}: {}'.format(', '.join(self.names), source),
+                       '<expr {!r}>'.format(text), 'eval')
+        self.func = eval(code, {'__builtins__': {}})
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def __repr__(self):
+        return 'CompiledExpression({!r})'.format(self.text)
+
+@lru_cache(maxsize=4096)
+def compile_expression(text):
+    return CompiledExpression(text)
+
+f = compile_expression('2 + (x + 4) * rate')
+print(f.names, f.source)
+print(f(x=3, rate=5))
+print(compile_expression('2 + (x + 4) * rate') is f)
+
+if __name__ == '__main__':
+    import time
+    import numpy as np
+
+    evaluator = ExpressionEvaluator()
+    start = time.perf_counter()
+    for i in range(20000):
+        evaluator.parse('2 + (3 + 4) * 5')
+    t_parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(20000):
+        compile_expression('2 + (x + 4) * 5')(x=3)
+    t_compiled = time.perf_counter() - start
+    print('parse() {:.3f}s  compile_expression() {:.3f}s'.format(
+          t_parse, t_compiled))
+
+    x = np.arange(1000000)
+    print(f(x=x, rate=0.5)[:5])
+
+# An operator-precedence parser with an explicit stack.
+
+"""ExpressionEvaluator makes a method call per grammar level per token
+and recurses on every parenthesis, so deeply nested input hits the
+recursion limit. PrecedenceEvaluator has the same parse() API but keeps
+its own stacks of values and pending operators: an operator first
+applies every stacked operator that binds at least as tightly (more
+tightly, for right-associative ones). Operators live in a table of
+token name -> (regex, precedence, function, right_assoc), and
+add_operator() extends it."""
+
+import operator
+
+class PrecedenceEvaluator:
+    operators = {
+        'PLUS':   (r'\+', 10, operator.add, False),
+        'MINUS':  (r'-', 10, operator.sub, False),
+        'TIMES':  (r'\*', 20, operator.mul, False),
+        'DIVIDE': (r'/', 20, operator.truediv, False),
+    }
+
+    def __init__(self):
+        self.operators = dict(self.operators)
+        self._compile()
+
+    def add_operator(self, name, regex, precedence, func, right_assoc=False):
+        self.operators[name] = (regex, precedence, func, right_assoc)
+        self._compile()
+
+    def _compile(self):
+        # Longer operator regexes first, so '**' wins over '*'.
+        ops = sorted(self.operators.items(), key=lambda item: -len(item[1][0]))
+        parts = [NUM, LPAREN, RPAREN, WS]
+        parts += ['(?P<{}>{})'.format(name, op[0]) for name, op in ops]
+        self._pat = re.compile('|'.join(parts))
+
+    def _tokens(self, text):
+        for m in iter(self._pat.scanner(text).match, None):
+            if m.lastgroup != 'WS':
+                yield m.lastgroup, m.group()
+
+    def parse(self, text):
+        operators = self.operators
+        values = []
+        pending = []          # (precedence, func) entries, or None for '('
+        expect_value = True
+
+        def reduce():
+            right = values.pop()
+            values[-1] = pending.pop()[1](values[-1], right)
+
+        for toktype, value in self._tokens(text):
+            if expect_value:
+                if toktype == 'NUM':
+                    values.append(int(value))
+                    expect_value = False
+                elif toktype == 'LPAREN':
+                    pending.append(None)
+                else:
+                    raise SyntaxError('Expected NUMBER or LPAREN')
+            elif toktype == 'RPAREN':
+                while pending and pending[-1] is not None:
+                    reduce()
+                if not pending:
+                    raise SyntaxError('Unexpected RPAREN')
+                pending.pop()
+            elif toktype in operators:
+                _, prec, func, right_assoc = operators[toktype]
+                while pending and pending[-1] is not None and (
+                        pending[-1][0] > prec or
+                        (pending[-1][0] == prec and not right_assoc)):
+                    reduce()
+                pending.append((prec, func))
+                expect_value = True
+            else:
+                raise SyntaxError('Expected operator')
+        if expect_value:
+            raise SyntaxError('Expected NUMBER or LPAREN')
+        while pending:
+            if pending[-1] is None:
+                raise SyntaxError('Expected RPAREN')
+            reduce()
+        return values[0]
+
+p = PrecedenceEvaluator()
+
+print(p.parse('2'))
+print(p.parse('2 + 3'))
+print(p.parse('2 + 3 * 4'))
+print(p.parse('2 + (3 + 4) * 5'))
+
+p.add_operator('POWER', r'\*\*', 30, operator.pow, right_assoc=True)
+print(p.parse('2 ** 3 ** 2'))
+
+if __name__ == '__main__':
+    import time
+
+    evaluator = ExpressionEvaluator()
+    p = PrecedenceEvaluator()
+    flat = ' + '.join('{} * {}'.format(i, i + 1) for i in range(20000))
+    for name, parser in [('ExpressionEvaluator', evaluator),
+                         ('PrecedenceEvaluator', p)]:
+        start = time.perf_counter()
+        parser.parse(flat)
+        print('{}: flat 40,000 terms {:.3f}s'.format(
+              name, time.perf_counter() - start))
+
+    for depth in (100, 5000):
+        nested = '(' * depth + '1 + 2' + ')' * depth
+        for name, parser in [('ExpressionEvaluator', evaluator),
+                             ('PrecedenceEvaluator', p)]:
+            start = time.perf_counter()
+            try:
+                parser.parse(nested)
+                result = '{:.4f}s'.format(time.perf_counter() - start)
+            except RecursionError:
+                result = 'RecursionError'
+            print('{}: nested depth {} {}'.format(name, depth, result))
+
+# Sharing identical subtrees, folding constants and eliminating common
+# subexpressions.
+
+"""ExpressionTreeBuilder makes new tuples for every parse, so the same
+subexpression appearing twice is stored twice. InterningTreeBuilder
+builds the same ('+', left, right) tuples (with NAME leaves for
+variables) but looks every node up in a table first, so structurally
+identical subtrees are one shared object and a set of formulas becomes
+a DAG. Since children are already shared, the table is keyed on their
+ids rather than hashing whole subtrees.
+
+fold_constants() rewrites the DAG bottom-up, evaluating operators whose
+operands are both numbers and dropping identities such as x * 1.
+compile_dag() generates a function that computes each shared node once
+into a temporary. Both passes memoize on node ids, so each shared node
+is visited once."""
+
+class InterningTreeBuilder(ExpressionEvaluator):
+    def __init__(self):
+        self._nodes = {}
+
+    def node(self, op, left, right):
+        key = (op,
+               id(left) if isinstance(left, tuple) else left,
+               id(right) if isinstance(right, tuple) else right)
+        node = self._nodes.get(key)
+        if node is None:
+            node = self._nodes[key] = (op, left, right)
+        return node
+
+    def parse(self, text):
+        self.tokens = generate_expr_tokens(text)
+        self.tok = None
+        self.nexttok = None
+        self._advance()
+        return self.expr()
+
+    def expr(self):
+        "expression ::= term { ('+'|'-') term }*"
+        exprval = self.term()
+        while self._accept('PLUS') or self._accept('MINUS'):
+            op = '+' if self.tok.type == 'PLUS' else '-'
+            exprval = self.node(op, exprval, self.term())
+        return exprval
+
+    def term(self):
+        "term ::= factor { ('*'|'/') factor }*"
+        termval = self.factor()
+        while self._accept('TIMES') or self._accept('DIVIDE'):
+            op = '*' if self.tok.type == 'TIMES' else '/'
+            termval = self.node(op, termval, self.factor())
+        return termval
+
+    def factor(self):
+        "factor ::= NUM | NAME | ( expr )"
+        if self._accept('NUM'):
+            return int(self.tok.value)
+        elif self._accept('NAME'):
+            return self.tok.value
+        elif self._accept('LPAREN'):
+            exprval = self.expr()
+            self._expect('RPAREN')
+            return exprval
+        else:
+            raise SyntaxError('Expected NUMBER, NAME or LPAREN')
+
+_TREE_OPS = {'+': operator.add, '-': operator.sub,
+             '*': operator.mul, '/': operator.truediv}
+
+def _is_number(node):
+    return isinstance(node, (int, float))
+
+def fold_constants(tree, builder, _memo=None):
+    memo = {} if _memo is None else _memo
+    if not isinstance(tree, tuple):
+        return tree
+    if id(tree) in memo:
+        return memo[id(tree)]
+    op, left, right = tree
+    left = fold_constants(left, builder, memo)
+    right = fold_constants(right, builder, memo)
+    if _is_number(left) and _is_number(right) and not (op == '/' and right == 0):
+        result = _TREE_OPS[op](left, right)
+    elif op in '+-' and right == 0 and _is_number(right):
+        result = left
+    elif op == '+' and left == 0 and _is_number(left):
+        result = right
+    elif op in '*/' and right == 1 and _is_number(right):
+        result = left
+    elif op == '*' and left == 1 and _is_number(left):
+        result = right
+    else:
+        result = builder.node(op, left, right)
+    memo[id(tree)] = result
+    return result
+
+def count_nodes(tree):
+    'Size of the tree written out in full'
+    if not isinstance(tree, tuple):
+        return 1
+    return 1 + count_nodes(tree[1]) + count_nodes(tree[2])
+
+def count_dag_nodes(*trees):
+    'Number of distinct nodes, counting shared subtrees once'
+    seen = set()
+    leaves = set()
+    stack = list(trees)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, tuple):
+            if id(node) not in seen:
+                seen.add(id(node))
+                stack.extend(node[1:])
+        else:
+            leaves.add(node)
+    return len(seen) + len(leaves)
+
+def compile_dag(tree):
+    'Compile to a function of the variables, computing shared nodes once'
+    uses = {}
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, tuple):
+            uses[id(node)] = uses.get(id(node), 0) + 1
+            if uses[id(node)] == 1:
+                stack.extend(node[1:])
+    lines = []
+    names = set()
+    temps = {}
+
+    def emit(node):
+        if not isinstance(node, tuple):
+            if isinstance(node, str):
+                names.add(node)
+            return repr(node) if _is_number(node) else node
+        if id(node) in temps:
+            return temps[id(node)]
+        op, left, right = node
+        src = '({} {} {})'.format(emit(left), op, emit(right))
+        if uses[id(node)] > 1:
+            temp = '_t{}'.format(len(temps))
+            lines.append('    {} = {}'.format(temp, src))
+            temps[id(node)] = temp
+            return temp
+        return src
+
+    result = emit(tree)
+    args = ', '.join(sorted(names))
+    src = 'def _expr({}):\n{}\n    return {}'.format(
+          args, '\n'.join(lines), result)
+    env = {'__builtins__': {}}
+    exec(src, env)
+    return env['_expr']
+
+def eval_tree(tree, env):
+    if isinstance(tree, tuple):
+        op, left, right = tree
+        return _TREE_OPS[op](eval_tree(left, env), eval_tree(right, env))
+    return env[tree] if isinstance(tree, str) else tree
+
+builder = InterningTreeBuilder()
+t1 = builder.parse('(x + y) * (x + y) + 2 * 3 * z')
+t2 = builder.parse('(x + y) * (x + y) - 1 * z')
+print(t1)
+print(t1[1] is t2[1])
+
+folded = fold_constants(t1, builder)
+print(folded)
+print(compile_dag(folded)(x=1, y=2, z=3), eval_tree(t1, {'x': 1, 'y': 2, 'z': 3}))
+
+corpus = [
+    'price * qty + price * qty * rate',
+    '(price * qty + tax) * (price * qty + tax) / (2 * 50)',
+    '(a + b) * (a + b) * (a + b) + (a + b) * 1 + 0',
+    '3 * 4 * x + (3 * 4 * x) / (10 - 8)',
+    '(x - y) * (x - y) + (x - y) * (x - y) * 1',
+]
+trees = [builder.parse(text) for text in corpus]
+folded = [fold_constants(t, builder) for t in trees]
+print('tree nodes {}  shared DAG nodes {}  after folding {}'.format(
+      sum(count_nodes(t) for t in trees),
+      count_dag_nodes(*trees), count_dag_nodes(*folded)))
+
+if __name__ == '__main__':
+    import time
+
+    env = {'price': 2.5, 'qty': 4, 'rate': 0.1, 'tax': 1.5, 'a': 1, 'b': 2,
+           'x': 3, 'y': 4}
+    start = time.perf_counter()
+    for _ in range(2000):
+        for tree in trees:
+            eval_tree(tree, env)
+    t_tree = time.perf_counter() - start
+
+    calls = []
+    for tree in folded:
+        func = compile_dag(tree)
+        code = func.__code__
+        calls.append((func, {name: env[name]
+                             for name in code.co_varnames[:code.co_argcount]}))
+    start = time.perf_counter()
+    for _ in range(2000):
+        for func, kwargs in calls:
+            func(**kwargs)
+    t_dag = time.perf_counter() - start
+    print('eval_tree {:.3f}s  folded compile_dag {:.3f}s'.format(t_tree, t_dag))
+
 
 # 2.20 Performing Text Operations on Byte Strings
 